@@ -1,10 +1,12 @@
 import argparse
+import functools
 import os
 import logging
 import logging.config
 import sys
 
 import yaml
+from shared import async_logging, tracing
 from . import offloader
 
 
@@ -26,6 +28,29 @@ def get_parser():
                         help="path to log configuration file",
                         type=lambda conf_path: is_valid_file(parser, conf_path),
                         required=True)
+    parser.add_argument("--profile",
+                        dest="profile_dir",
+                        help="folder to store JSON trace, cProfile stats and per-row timing breakdown into",
+                        default=None)
+    parser.add_argument("--profile-row-sample",
+                        dest="profile_row_sample",
+                        help="trace every N-th processed row, default 100",
+                        type=int,
+                        default=100)
+    parser.add_argument("--record",
+                        dest="record_bundle",
+                        help="folder to record scrubbed Lightspeed exchanges and SFTP files into for a later replay",
+                        default=None)
+    parser.add_argument("--plan",
+                        dest="plan_only",
+                        help="only log expected number of Lightspeed calls and duration of the run, and exit",
+                        action="store_true")
+    parser.add_argument("--max-runtime",
+                        dest="max_runtime",
+                        help="number of minutes the run may take, e.g. the cron interval, no new order is taken after "
+                             "that, and the rest is left for the next run",
+                        type=float,
+                        default=None)
 
     return parser
 
@@ -59,7 +84,7 @@ def setup_logging(path="./config/logging.yaml", default_level=logging.INFO):
     if os.path.exists(path):
         with open(path, "rt") as f:
             log_config = yaml.safe_load(f.read())
-        logging.config.dictConfig(log_config)
+        async_logging.configure_logging(log_config)
     else:
         logging.basicConfig(level=default_level)
 
@@ -73,4 +98,13 @@ setup_logging(path=log_config_path)
 
 # Run app
 app_config_path = args.config
-sys.exit(offloader.run(app_config_path))
+config_parser_factory = None
+if args.record_bundle:
+    from replay.recording import RecordingConfigParser
+    config_parser_factory = functools.partial(RecordingConfigParser, bundle_path=args.record_bundle)
+
+max_runtime = args.max_runtime * 60 if args.max_runtime else None
+
+with tracing.profiling(args.profile_dir, "lightspeed_offloader", args.profile_row_sample):
+    exit_code = offloader.run(app_config_path, config_parser_factory, args.plan_only, max_runtime)
+sys.exit(exit_code)
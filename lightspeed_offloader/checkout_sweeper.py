@@ -0,0 +1,58 @@
+import logging
+
+from shared.exceptions import CircuitOpenException, UnexpectedHTTPStatusCodeException
+from shared.state_store import load_state, save_state
+
+log = logging.getLogger(__name__)
+
+
+class CheckoutSweeper:
+    """
+    Deletes orphan checkouts, i.e. checkouts, which have been created, but never converted into orders, e.g. since
+    their validation has failed. Checkouts, which cannot be deleted, are kept in the state file, and the next run tries
+    it again.
+
+    :param state_path: (str) path to the JSON file with the orphan checkout ids, kept in memory only if None
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self._checkout_ids = set(load_state(state_path, default=[])) if state_path else set()
+
+    def add(self, checkout_ids):
+        """
+        :param checkout_ids: collection of ids of the orphan checkouts
+        """
+        self._checkout_ids.update(checkout_ids)
+
+    def sweep(self, lightspeed_client):
+        """
+        Deletes all the known orphan checkouts. Deletion stops as soon as the circuit breaker finds Lightspeed
+        unavailable.
+        :param lightspeed_client: (LightspeedClient) instance of the LightspeedClient class
+        :return: number of deleted checkouts
+        """
+        deleted = 0
+        for checkout_id in sorted(self._checkout_ids):
+            try:
+                lightspeed_client.delete_checkout(checkout_id)
+            except CircuitOpenException as e:
+                log.error(f"Lightspeed is unavailable, orphan checkouts will be deleted by the next run.\nError: {e}")
+                break
+            except UnexpectedHTTPStatusCodeException as e:
+                log.error(f"Failed to delete orphan checkout {checkout_id}.\nError: {e}")
+                continue
+
+            self._checkout_ids.discard(checkout_id)
+            deleted += 1
+
+        if deleted:
+            log.info(f"Deleted {deleted} orphan checkouts, {len(self._checkout_ids)} are left for the next run")
+        return deleted
+
+    def save(self):
+        """
+        Saves ids of the checkouts, which haven't been deleted yet, into the state file.
+        """
+        if self.state_path:
+            save_state(self.state_path, sorted(self._checkout_ids))
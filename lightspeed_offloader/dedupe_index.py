@@ -0,0 +1,72 @@
+import hashlib
+import time
+
+from shared.state_store import load_state, save_state
+
+
+class DedupeIndex:
+    """
+    Remembers content hashes of the processed input files, and (Belegnummer, Positionsnummer) keys of the rows, which
+    orders have been created for, so a re-uploaded export never creates the same order twice. Entries older than the
+    horizon are forgotten to keep the index small.
+
+    :param state_path: (str) path to the JSON file with the index, the index is kept in memory only if None
+    :param horizon: (number) number of seconds an entry is remembered for
+    """
+
+    def __init__(self, state_path=None, horizon=90 * 24 * 60 * 60):
+        self.state_path = state_path
+        self.horizon = horizon
+
+        state = load_state(state_path, default={}) if state_path else {}
+        self._files = state.get("files", {})
+        self._rows = state.get("rows", {})
+
+    @staticmethod
+    def get_content_hash(lines):
+        """
+        :param lines: (list) lines of the file
+        :return: (str) SHA-256 hex digest of the file content
+        """
+        content_hash = hashlib.sha256()
+        for line in lines:
+            content_hash.update(line.encode("utf-8"))
+        return content_hash.hexdigest()
+
+    def get_processed_file(self, content_hash):
+        """
+        :param content_hash: (str) content hash of the file
+        :return: (str) path to the file processed with the same content, or None
+        """
+        file = self._files.get(content_hash)
+        return file["path"] if file else None
+
+    def add_file(self, content_hash, file_path):
+        self._files[content_hash] = {"path": file_path, "processed_at": time.time()}
+
+    def is_submitted(self, row):
+        """
+        :param row: (ExportedOrder) row of the input file
+        :return: True if an order has already been created for the row
+        """
+        return self._get_row_key(row) in self._rows
+
+    def add_row(self, row):
+        self._rows[self._get_row_key(row)] = time.time()
+
+    def save(self):
+        """
+        Forgets entries older than the horizon, and saves the index into the state file.
+        """
+        if not self.state_path:
+            return
+
+        oldest = time.time() - self.horizon
+        self._files = {content_hash: file for content_hash, file in self._files.items()
+                       if file["processed_at"] >= oldest}
+        self._rows = {key: submitted_at for key, submitted_at in self._rows.items() if submitted_at >= oldest}
+        save_state(self.state_path, {"files": self._files, "rows": self._rows})
+
+    @staticmethod
+    def _get_row_key(row):
+        return f"{row.order_id}|{row.position_num}"
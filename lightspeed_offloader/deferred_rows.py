@@ -0,0 +1,63 @@
+import logging
+import time
+
+from shared.csv_reader import ExportedOrder
+from shared.state_store import load_state, save_state
+
+log = logging.getLogger(__name__)
+
+
+class DeferredRows:
+    """
+    Keeps rows of the archived input files, which have been deferred, since their variant is out of stock, so they
+    are retried by the next runs. Rows deferred longer than the horizon are dropped and reported.
+
+    :param state_path: (str) path to the JSON file with the deferred rows, the rows are kept in memory only if None
+    :param horizon: (number) number of seconds a row is retried for
+    """
+
+    def __init__(self, state_path=None, horizon=7 * 24 * 60 * 60):
+        self.state_path = state_path
+        self.horizon = horizon
+        self._rows = load_state(state_path, default={}) if state_path else {}
+        self._taken_rows = {}
+
+    def add(self, row):
+        """
+        Defers the row. A row taken for a retry, or deferred again, keeps the time it has been deferred for the first
+        time.
+        :param row: (ExportedOrder) row of the input file
+        """
+        key = self._get_row_key(row)
+        taken_row = self._taken_rows.pop(key, None)
+        deferred_at = (self._rows.get(key) or taken_row or {}).get("deferred_at", time.time())
+        self._rows[key] = {"row": list(row), "deferred_at": deferred_at}
+
+    def has_rows(self):
+        return bool(self._rows)
+
+    def take_rows(self):
+        """
+        Takes all the deferred rows for a retry. Rows, which are not deferred again, are forgotten.
+        :return: a list of ExportedOrder records
+        """
+        self._taken_rows.update(self._rows)
+        self._rows = {}
+        return [ExportedOrder._make(entry["row"]) for entry in self._taken_rows.values()]
+
+    def save(self):
+        """
+        Drops rows older than the horizon, and saves the rows into the state file.
+        """
+        oldest = time.time() - self.horizon
+        for key, entry in list(self._rows.items()):
+            if entry["deferred_at"] < oldest:
+                log.error(f"Row {key} has been out of stock for too long, dropping it without creating an order")
+                del self._rows[key]
+
+        if self.state_path:
+            save_state(self.state_path, self._rows)
+
+    @staticmethod
+    def _get_row_key(row):
+        return f"{row.order_id}|{row.position_num}"
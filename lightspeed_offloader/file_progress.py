@@ -0,0 +1,35 @@
+from shared.state_store import load_state, save_state
+
+
+class FileProgress:
+    """
+    Keeps the number of already processed rows of the input files, which have been interrupted, e.g. by a Lightspeed
+    outage, so the next run resumes every file where the previous one has stopped instead of creating the orders
+    again.
+
+    :param state_path: (str) path to the JSON file with the progress, the progress is kept in memory only if None
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self._offsets = load_state(state_path, default={}) if state_path else {}
+
+    def get_offset(self, file_path):
+        """
+        :param file_path: (str) path to the input file on SFTP server
+        :return: number of rows processed by previous runs
+        """
+        return self._offsets.get(file_path, 0)
+
+    def set_offset(self, file_path, offset):
+        self._offsets[file_path] = offset
+
+    def clear(self, file_path):
+        self._offsets.pop(file_path, None)
+
+    def save(self):
+        """
+        Saves the progress into the state file.
+        """
+        if self.state_path:
+            save_state(self.state_path, self._offsets)
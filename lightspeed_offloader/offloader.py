@@ -1,93 +1,449 @@
-import csv
+import functools
 import logging.config
-import os
-import shutil
+from itertools import islice
 
 import yaml
 
-from shared import csv_writer
-from shared.const.csv_column_names import ExportedOrderCSV, OrderConfirmationCSV
-from shared.exceptions import ProcessOrderException, UnexpectedHTTPStatusCodeException
+from shared import csv_writer, tracing
+from shared.csv_reader import OrderConfirmation, read_exported_orders
+from shared.const.csv_column_names import OrderConfirmationCSV
+from shared.exceptions import (CircuitOpenException, CSVFormatException, LightspeedUnavailableException,
+                               OutOfStockException, ProcessOrderException, UnexpectedHTTPStatusCodeException)
+from shared.async_logging import log_context, update_log_context
+from shared.run_budget import RunBudget
+from . import planner
+from .checkout_sweeper import CheckoutSweeper
+from .dedupe_index import DedupeIndex
+from .deferred_rows import DeferredRows
+from .file_progress import FileProgress
 
-"""Folder name in which temporary files are stored"""
-TMP_FOLDER = "tmp"
 """Email suffix used in the output CSV files."""
 EMAIL_SUFFIX = "@westfalia.eu"
+"""Checkout mode, which creates an order with a separate Lightspeed call per checkout step"""
+CHECKOUT_MODE_STEP_BY_STEP = "step-by-step"
+"""Checkout mode, which folds checkout steps into as few Lightspeed calls as the API allows"""
+CHECKOUT_MODE_FAST = "fast"
+"""Expected number of Lightspeed calls per processed row, i.e. per created order, in the given checkout mode"""
+CALLS_PER_ROW = {
+    CHECKOUT_MODE_STEP_BY_STEP: 6,
+    CHECKOUT_MODE_FAST: 2
+}
+"""Rows ordering more items than the variant has in stock fail without creating a checkout"""
+OUT_OF_STOCK_POLICY_REJECT = "reject"
+"""Rows ordering more items than the variant has in stock are retried by the next runs"""
+OUT_OF_STOCK_POLICY_DEFER = "defer"
 
 log = logging.getLogger(__name__)
 
 
-def _process_files(sftp_client, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id):
-    """Fetches all the CSV files needed to be processed from SFTP server. Parses them, and
+class FileInterruptedException(Exception):
+    """
+    Processing of the file has been stopped, since Lightspeed is unavailable.
+
+    :param processed_orders: (list) confirmations of the orders created before the interruption
+    :param resume_row: (number) index of the first row, which has to be processed by the next run
+    """
+
+    def __init__(self, message, processed_orders, resume_row):
+        super().__init__(message)
+        self.processed_orders = processed_orders
+        self.resume_row = resume_row
+
+
+class RunBudgetExhaustedException(FileInterruptedException):
+    """
+    Processing of the file has been stopped, since the run budget is exhausted.
+    """
+
+
+class FileIncompleteException(FileInterruptedException):
+    """
+    The whole file has been processed, but some of its rows have failed, since Lightspeed has been unavailable. The
+    file is resumed from the first of them by the next run, rows created since then are skipped by the dedupe index.
+    """
+
+
+class CheckoutShortcuts:
+    """
+    Shortcuts of the fast checkout mode, which Lightspeed has honored so far. Once a shortcut is rejected or ignored,
+    the following rows of the run go straight to the corresponding step-by-step calls instead of paying for the failed
+    attempt first.
+    """
+
+    def __init__(self):
+        self.create_with_details = True
+        self.products_in_payload = True
+        self.methods_in_payload = True
+        self.finish_with_details = True
+        self.payment_status_at_finish = True
+        self.processed_rows = 0
+
+    def disable(self, shortcut):
+        """
+        :param shortcut: (str) name of the shortcut attribute, e.g. 'products_in_payload'
+        """
+        if getattr(self, shortcut):
+            log.warning(f"Lightspeed doesn't honor '{shortcut}' shortcut, using step-by-step calls for the rest of "
+                        f"the run")
+            setattr(self, shortcut, False)
+
+    def get_calls_per_row(self):
+        """
+        :return: number of Lightspeed calls per row on the path observed so far
+        """
+        if not self.create_with_details:
+            return CALLS_PER_ROW[CHECKOUT_MODE_STEP_BY_STEP]
+
+        set_paid_calls = 0 if self.finish_with_details and self.payment_status_at_finish else 1
+        return 1 + (not self.products_in_payload) + (not self.methods_in_payload) + 1 + set_paid_calls
+
+
+def _process_files(sftp_client, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id,
+                   checkout_mode=CHECKOUT_MODE_STEP_BY_STEP, post_finish_queue=None, run_limits=None,
+                   plan_only=False, file_progress=None, dedupe_index=None, run_budget=None, deferred_rows=None,
+                   checkout_shortcuts=None):
+    """Fetches all the CSV files needed to be processed from SFTP server. Plans the run, parses the files, and
     generates orders via Lightspeed API. If the process finishes successfully, creates new CSV file with the
-    status attribute and archives processed file.
+    status attribute and archives processed file. Files, which don't fit into the run limits, are left for the next
+    run. If Lightspeed becomes unavailable, the run stops, orders created so far are confirmed, and the interrupted
+    file is resumed by the next run. Files with already processed content are archived without any API call, and rows,
+    which orders have already been created for, are skipped. Once the run budget is exhausted, no new row is taken,
+    orders created so far are confirmed, and the remaining rows and files are left for the next run. Rows deferred by
+    previous runs, since their variant has been out of stock, are retried before the files.
 
     :param sftp_client: (SFTPClient) instance of the SFTPClient class
     :param lightspeed_client: (LightspeedClient) instance of the LightspeedClient class
     :param lightspeed_shipment_id: (str) ID needed to build shipment method ID
     :param lightspeed_shipment_value_id: (str) ID needed to build shipment method ID
+    :param checkout_mode: (str) either CHECKOUT_MODE_STEP_BY_STEP or CHECKOUT_MODE_FAST
+    :param post_finish_queue: (PostFinishQueue) queue to defer setting payment status to, if None, payment status is
+    set synchronously
+    :param run_limits: (RunLimits) limits of the run, if None, all the files are processed
+    :param plan_only: (bool) if True, only logs the plan of the run without creating any order
+    :param file_progress: (FileProgress) processed rows of the interrupted files, kept in memory only if None
+    :param dedupe_index: (DedupeIndex) processed files and rows, kept in memory only if None
+    :param run_budget: (RunBudget) time budget of the run, not limited if None
+    :param deferred_rows: (DeferredRows) rows deferred since their variant is out of stock, if None, such rows fail
+    :param checkout_shortcuts: (CheckoutShortcuts) shortcuts of the fast checkout mode honored by Lightspeed during
+    the run, every row tries all of them if None
     """
-    files_to_process = sftp_client.list_input_files()
-
-    if not files_to_process:
+    file_progress = file_progress or FileProgress()
+    dedupe_index = dedupe_index or DedupeIndex()
+    process_file = functools.partial(_process_file, lightspeed_client=lightspeed_client,
+                                     lightspeed_shipment_id=lightspeed_shipment_id,
+                                     lightspeed_shipment_value_id=lightspeed_shipment_value_id,
+                                     checkout_mode=checkout_mode, post_finish_queue=post_finish_queue,
+                                     dedupe_index=dedupe_index, run_budget=run_budget, deferred_rows=deferred_rows,
+                                     checkout_shortcuts=checkout_shortcuts)
+
+    with tracing.span("list input files"):
+        files_to_process = sftp_client.list_input_files()
+
+    if not files_to_process and not (deferred_rows and deferred_rows.has_rows()):
         log.warning("No new files detected")
         return
 
+    with tracing.span("plan run", files=len(files_to_process)):
+        calls_per_row = CALLS_PER_ROW[checkout_mode]
+        if run_limits:
+            calls_per_row = planner.load_calls_per_row(run_limits.state_path, checkout_mode, calls_per_row)
+        plan = planner.plan_run(sftp_client, lightspeed_client, files_to_process, calls_per_row, run_limits,
+                                dedupe_index)
+    planner.log_plan(plan)
+    if plan_only:
+        return
+
+    for duplicate_file in plan.duplicate_files:
+        with tracing.span("archive file", file=duplicate_file.path):
+            sftp_client.archive_file(duplicate_file.path)
+
     orders_to_save = []
-    for file_path in files_to_process:
-        log.info(f"Processing file {file_path}")
-        file = sftp_client.get_file(file_path)
+    files_to_process = plan.files
+    retried_rows = deferred_rows.take_rows() if deferred_rows else []
+    if retried_rows:
+        log.info(f"Retrying {len(retried_rows)} rows deferred by previous runs, since their variant has been out of "
+                 f"stock")
+        try:
+            with tracing.span("process deferred rows", rows=len(retried_rows)):
+                orders_to_save.extend(process_file(retried_rows))
+        except FileIncompleteException as e:
+            log.warning(f"{e}. {len(retried_rows) - e.resume_row} deferred rows are left for the next run.")
+            for row in retried_rows[e.resume_row:]:
+                deferred_rows.add(row)
+            orders_to_save.extend(e.processed_orders)
+        except FileInterruptedException as e:
+            log.warning(f"{e}. Stopping the run, {len(retried_rows) - e.resume_row} deferred rows are left for the "
+                        f"next run, files are left unprocessed.")
+            for row in retried_rows[e.resume_row:]:
+                deferred_rows.add(row)
+            orders_to_save.extend(e.processed_orders)
+            files_to_process = []
+
+    for file_number, planned_file in enumerate(files_to_process):
+        file_path = planned_file.path
+        if run_budget and run_budget.is_exhausted():
+            log.warning(f"Run budget is exhausted, leaving {len(files_to_process) - file_number} files for the next "
+                        f"run.")
+            break
+
+        # A copy of a file processed earlier by this run
+        content_hash = planned_file.content_hash
+        processed_file = dedupe_index.get_processed_file(content_hash)
+        if processed_file:
+            log.warning(f"File {file_path} has the same content as already processed file {processed_file}, "
+                        f"archiving it without creating any order.")
+            with tracing.span("archive file", file=file_path):
+                sftp_client.archive_file(file_path)
+            continue
 
-        log.debug(f"Parsing file {file_path}")
-        parsed_file = csv.DictReader(file, delimiter=';')
+        log.info(f"Processing file {file_path}")
 
-        processed_orders = _process_file(parsed_file,
-                                         lightspeed_client,
-                                         lightspeed_shipment_id,
-                                         lightspeed_shipment_value_id
-                                         )
+        log.debug("Parsing file %s", file_path)
+        parsed_file = read_exported_orders(planned_file.lines)
 
-        file.close()
+        start_row = file_progress.get_offset(file_path)
+        if start_row:
+            log.info(f"Resuming file {file_path} from row {start_row}")
 
-        sftp_client.archive_file(file_path)
+        try:
+            with tracing.span("process file", file=file_path):
+                processed_orders = process_file(parsed_file, start_row=start_row)
+        except CSVFormatException as e:
+            log.error(f"Cannot parse file {file_path}, skipping it.\nError: {e}")
+            continue
+        except RunBudgetExhaustedException as e:
+            log.warning(f"{e}. Stopping the run, file {file_path} will be resumed from row {e.resume_row} by the "
+                        f"next run, remaining files are left unprocessed.")
+            file_progress.set_offset(file_path, e.resume_row)
+            orders_to_save.extend(e.processed_orders)
+            break
+        except FileIncompleteException as e:
+            log.error(f"{e}. File {file_path} is left in the input folder, and it will be resumed from row "
+                      f"{e.resume_row} by the next run.")
+            file_progress.set_offset(file_path, e.resume_row)
+            orders_to_save.extend(e.processed_orders)
+            continue
+        except FileInterruptedException as e:
+            log.error(f"{e}. Stopping the run, file {file_path} will be resumed from row {e.resume_row} by the next "
+                      f"run, remaining files are left unprocessed.")
+            file_progress.set_offset(file_path, e.resume_row)
+            orders_to_save.extend(e.processed_orders)
+            break
+
+        with tracing.span("archive file", file=file_path):
+            sftp_client.archive_file(file_path)
+        file_progress.clear(file_path)
+        dedupe_index.add_file(content_hash, file_path)
         orders_to_save.extend(processed_orders)
 
     if orders_to_save:
-        processed_orders_csv = csv_writer.save_orders_as_csv(TMP_FOLDER, orders_to_save,
-                                                             OrderConfirmationCSV.FIELDNAMES)
-        sftp_client.upload_processed_orders(processed_orders_csv)
+        with tracing.span("serialize orders as CSV", orders=len(orders_to_save)):
+            file_name, content = csv_writer.serialize_orders_as_csv(orders_to_save, OrderConfirmationCSV.FIELDNAMES)
+        with tracing.span("upload processed orders"):
+            sftp_client.upload_processed_orders(file_name, content)
     else:
         log.warning("No orders have processed")
 
 
-def _process_file(file, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id):
+def _process_file(file, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id,
+                  checkout_mode=CHECKOUT_MODE_STEP_BY_STEP, post_finish_queue=None, start_row=0, dedupe_index=None,
+                  run_budget=None, deferred_rows=None, checkout_shortcuts=None):
+    """
+    Creates an order for every row of the file, which no order has been created for yet.
+    :param file: iterable of ExportedOrder records
+    :param start_row: (number) index of the first row to process, rows before it have been processed by previous runs
+    :param dedupe_index: (DedupeIndex) rows, which orders have already been created for, may be None
+    :param run_budget: (RunBudget) time budget of the run, checked before every row, not limited if None
+    :param deferred_rows: (DeferredRows) rows ordering variants out of stock are deferred into it, if None, such rows
+    fail
+    :param checkout_shortcuts: (CheckoutShortcuts) shortcuts of the fast checkout mode honored by Lightspeed, may be
+    None
+    :return: confirmations of the created orders, or throws FileInterruptedException if Lightspeed has become
+    unavailable, RunBudgetExhaustedException if the run budget is exhausted, or FileIncompleteException if some rows
+    have failed, since Lightspeed has been unavailable
+    """
     processed_orders = []
-
-    for row in file:
-        try:
-            order_id = _process_row(row, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id)
-            log.info(f"Order with {order_id} has been successfully created for {row[ExportedOrderCSV.ORDER_ID]}")
-            order = _create_order_confirmation(order_id, row)
-            processed_orders.append(order)
-        except (ProcessOrderException, UnexpectedHTTPStatusCodeException) as e:
-            log.error(f"Error occurred while processing order {row[ExportedOrderCSV.ORDER_ID]}")
-            log.error(str(e))
+    # The file is resumed from the first row failed since Lightspeed has been unavailable, even if later rows succeed
+    unavailable_since_row = None
+    skipped_rows = 0
+
+    for row_index, row in enumerate(islice(file, start_row, None), start_row):
+        if run_budget and run_budget.is_exhausted():
+            resume_row = unavailable_since_row if unavailable_since_row is not None else row_index
+            raise RunBudgetExhaustedException("Run budget is exhausted", processed_orders, resume_row)
+
+        if dedupe_index and dedupe_index.is_submitted(row):
+            log.warning("Order for %s position %s has already been created, skipping it", row.order_id,
+                        row.position_num)
+            skipped_rows += 1
+            continue
+
+        with log_context(order_id=row.order_id):
+            try:
+                with tracing.row_span("process row", order=row.order_id):
+                    order_id = _process_row(row, lightspeed_client, lightspeed_shipment_id,
+                                            lightspeed_shipment_value_id, checkout_mode, post_finish_queue,
+                                            checkout_shortcuts)
+                log.info("Order with %s has been successfully created for %s", order_id, row.order_id)
+                order = _create_order_confirmation(order_id, row)
+                processed_orders.append(order)
+                if dedupe_index:
+                    dedupe_index.add_row(row)
+            except CircuitOpenException as e:
+                resume_row = unavailable_since_row if unavailable_since_row is not None else row_index
+                raise FileInterruptedException(str(e), processed_orders, resume_row) from e
+            except OutOfStockException as e:
+                if deferred_rows is None:
+                    log.error("Order %s cannot be created: %s", row.order_id, e)
+                else:
+                    log.warning("Deferring order %s to the next run: %s", row.order_id, e)
+                    deferred_rows.add(row)
+            except (ProcessOrderException, UnexpectedHTTPStatusCodeException) as e:
+                log.error("Error occurred while processing order %s", row.order_id)
+                log.error(str(e))
+                if isinstance(e, LightspeedUnavailableException) and unavailable_since_row is None:
+                    unavailable_since_row = row_index
+
+    if skipped_rows:
+        log.warning(f"Skipped {skipped_rows} rows, which orders have already been created for")
+
+    if unavailable_since_row is not None:
+        raise FileIncompleteException(f"Rows since {unavailable_since_row} have failed, since Lightspeed has been "
+                                      f"unavailable", processed_orders, unavailable_since_row)
 
     return processed_orders
 
 
-def _process_row(row, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id):
-    checkout = _generate_checkout(row)
-    checkout_id = lightspeed_client.create_checkout(checkout)
+def _process_row(row, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id,
+                 checkout_mode=CHECKOUT_MODE_STEP_BY_STEP, post_finish_queue=None, checkout_shortcuts=None):
+    if checkout_mode == CHECKOUT_MODE_FAST:
+        return _process_row_fast(row, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id,
+                                 post_finish_queue, checkout_shortcuts)
 
+    # Rows, which would certainly fail the validation, are rejected before any checkout is created
     variant_id = _get_variant_id(row, lightspeed_client)
+    _check_stock(row, variant_id, lightspeed_client)
+
+    checkout = _generate_checkout(row)
+    checkout_id = lightspeed_client.create_checkout(checkout)
+    update_log_context(checkout_id=checkout_id)
 
     product = _generate_product_for_checkout(row, variant_id)
     lightspeed_client.add_product_to_checkout(product, checkout_id)
 
     methods_info = _generate_shipment_and_payment_methods(lightspeed_shipment_id, lightspeed_shipment_value_id)
     checkout = lightspeed_client.add_shipment_and_payment_methods(methods_info, checkout_id)
+    _check_shipment_and_payment_methods(checkout, checkout_id)
+
+    validation = lightspeed_client.validate_checkout(checkout_id)
+    _check_validation(validation, checkout_id)
+
+    order_id = lightspeed_client.finish_checkout(checkout_id)
+    _reserve_stock(row, variant_id, lightspeed_client)
+
+    _set_order_paid(order_id, lightspeed_client, post_finish_queue)
+
+    return order_id
+
+
+def _process_row_fast(row, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id,
+                      post_finish_queue=None, checkout_shortcuts=None):
+    """
+    Creates an order using as few Lightspeed calls as possible. Product, shipment and payment methods are sent
+    within the checkout creation payload, separate validation is skipped, since Lightspeed validates the checkout
+    while finishing it, and payment status is sent at finish time. Every shortcut, which is not honored by Lightspeed,
+    falls back to the corresponding step of the step-by-step flow, and it is not tried again by the following rows.
+    :param row: (ExportedOrder) a single line from CSV file obtained from SFTP server
+    :param lightspeed_client: (LightspeedClient) instance of the LightspeedClient class
+    :param lightspeed_shipment_id: (str) ID needed to build shipment method ID
+    :param lightspeed_shipment_value_id: (str) ID needed to build shipment method ID
+    :param post_finish_queue: (PostFinishQueue) queue to defer setting payment status to, may be None
+    :param checkout_shortcuts: (CheckoutShortcuts) shortcuts honored by Lightspeed so far, all of them are tried if None
+    :return: id of the created order
+    """
+    shortcuts = checkout_shortcuts or CheckoutShortcuts()
+    shortcuts.processed_rows += 1
+    if not shortcuts.create_with_details:
+        return _process_row(row, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id,
+                            CHECKOUT_MODE_STEP_BY_STEP, post_finish_queue)
+
+    variant_id = _get_variant_id(row, lightspeed_client)
+    _check_stock(row, variant_id, lightspeed_client)
+    product = _generate_product_for_checkout(row, variant_id)
+    methods_info = _generate_shipment_and_payment_methods(lightspeed_shipment_id, lightspeed_shipment_value_id)
+
+    checkout = _generate_checkout(row)
+    if shortcuts.products_in_payload:
+        checkout["products"] = [product]
+    if shortcuts.methods_in_payload:
+        checkout.update(methods_info)
+    try:
+        checkout = lightspeed_client.create_checkout_with_details(checkout)
+    except LightspeedUnavailableException:
+        raise
+    except UnexpectedHTTPStatusCodeException as e:
+        log.warning(f"Checkout payload for {row.order_id} has been rejected, falling back to step-by-step checkout.\n"
+                    f"Error: {e}")
+        order_id = _process_row(row, lightspeed_client, lightspeed_shipment_id, lightspeed_shipment_value_id,
+                                CHECKOUT_MODE_STEP_BY_STEP, post_finish_queue)
+        # The step-by-step checkout has accepted the row, so the payload shortcut itself has been rejected
+        shortcuts.disable("create_with_details")
+        return order_id
+    checkout_id = checkout["id"]
+    update_log_context(checkout_id=checkout_id)
+
+    if not checkout.get("products"):
+        if shortcuts.products_in_payload:
+            log.debug("Products have been ignored in checkout %s payload, adding them separately", checkout_id)
+            shortcuts.disable("products_in_payload")
+        lightspeed_client.add_product_to_checkout(product, checkout_id)
+
+    if not checkout.get("payment_method") or not checkout.get("shipment_method"):
+        if shortcuts.methods_in_payload:
+            log.debug("Methods have been ignored in checkout %s payload, adding them separately", checkout_id)
+            shortcuts.disable("methods_in_payload")
+        checkout = lightspeed_client.add_shipment_and_payment_methods(methods_info, checkout_id)
+        _check_shipment_and_payment_methods(checkout, checkout_id)
+
+    if shortcuts.finish_with_details and shortcuts.payment_status_at_finish:
+        finished_checkout = _finish_checkout_with_payment_status(checkout_id, lightspeed_client, shortcuts)
+    else:
+        finished_checkout = {"order_id": lightspeed_client.finish_checkout(checkout_id)}
+
+    order_id = finished_checkout["order_id"]
+    _reserve_stock(row, variant_id, lightspeed_client)
+
+    if finished_checkout.get("paymentStatus") != "paid":
+        _set_order_paid(order_id, lightspeed_client, post_finish_queue)
+
+    return order_id
+
 
+def _finish_checkout_with_payment_status(checkout_id, lightspeed_client, shortcuts: CheckoutShortcuts):
+    finish_info = {"comment": ""}
+    finish_info.update(_generate_payment_status()["order"])
+    try:
+        finished_checkout = lightspeed_client.finish_checkout_with_details(checkout_id, finish_info)
+    except LightspeedUnavailableException:
+        raise
+    except UnexpectedHTTPStatusCodeException:
+        # Fetch validation errors to explain, why the checkout has been rejected
+        validation = lightspeed_client.validate_checkout(checkout_id)
+        _check_validation(validation, checkout_id)
+
+        log.debug("Finish payload of checkout %s has been rejected, finishing it without payment status", checkout_id)
+        finished_checkout = {"order_id": lightspeed_client.finish_checkout(checkout_id)}
+        # The valid checkout has been finished without the payload, so the payload shortcut itself has been rejected
+        shortcuts.disable("finish_with_details")
+        return finished_checkout
+
+    if finished_checkout.get("paymentStatus") != "paid":
+        log.debug("Payment status has been ignored at finish of checkout %s, updating it separately", checkout_id)
+        shortcuts.disable("payment_status_at_finish")
+    return finished_checkout
+
+
+def _check_shipment_and_payment_methods(checkout, checkout_id):
     if not checkout["payment_method"]:
         err_message = (f"Failed to add payment method to checkout {checkout_id}\n"
                        f"Checkout: {checkout}")
@@ -98,46 +454,54 @@ def _process_row(row, lightspeed_client, lightspeed_shipment_id, lightspeed_ship
                        f"Checkout: {checkout}")
         raise ProcessOrderException(err_message)
 
-    validation = lightspeed_client.validate_checkout(checkout_id)
 
+def _check_validation(validation, checkout_id):
     if not validation["validated"]:
         err_message = (f"Checkout {checkout_id} haven't passed validation\n"
                        f"Validation errors: {validation['errors']}")
         raise ProcessOrderException(err_message)
 
-    order_id = lightspeed_client.finish_checkout(checkout_id)
+
+def _set_order_paid(order_id, lightspeed_client, post_finish_queue=None):
+    if post_finish_queue:
+        # The order already exists, so it is confirmed right away, and failures are retried by the queue
+        post_finish_queue.submit_set_paid(order_id)
+        return
 
     payment_status = _generate_payment_status()
-    order = lightspeed_client.update_order_payment_status(order_id, payment_status)
+    try:
+        order = lightspeed_client.update_order_payment_status(order_id, payment_status)
+    except (CircuitOpenException, LightspeedUnavailableException) as e:
+        # The order already exists, so the row must not be processed again once Lightspeed is available
+        raise ProcessOrderException(f"Order {order_id} has been created, but its payment status cannot be updated.\n"
+                                    f"Error: {e}") from e
     if order["paymentStatus"] != "paid":
         err_message = f"Failed to update payment status of order {order_id}"
         raise ProcessOrderException(err_message)
 
-    return order_id
-
 
 def _generate_checkout(row):
     """
     Creates Lightspeed checkout object from a given CSV file row. See https://developers.lightspeedhq.com/ecom/endpoints/checkout/#post-create-a-new-checkout
-    :param row: (str) a single line from CSV file obtained from SFTP server
+    :param row: (ExportedOrder) a single line from CSV file obtained from SFTP server
     :return: a checkout dictionary representation
     """
 
     def _generate_address(exported_order):
         return {
-            "name": exported_order[ExportedOrderCSV.FIRST_NAME] + " " + exported_order[ExportedOrderCSV.LAST_NAME],
-            "address1": exported_order[ExportedOrderCSV.ADDRESS_STREET],
-            "address2": exported_order[ExportedOrderCSV.COMPANY],
-            "zipcode": exported_order[ExportedOrderCSV.ZIP],
-            "city": exported_order[ExportedOrderCSV.CITY],
-            "country": exported_order[ExportedOrderCSV.COUNTRY],
-            "number": exported_order[ExportedOrderCSV.ADDRESS_HOUSE]
+            "name": exported_order.first_name + " " + exported_order.last_name,
+            "address1": exported_order.address_street,
+            "address2": exported_order.company,
+            "zipcode": exported_order.zip,
+            "city": exported_order.city,
+            "country": exported_order.country,
+            "number": exported_order.address_house
         }
 
     customer = {
-        "firstname": row[ExportedOrderCSV.FIRST_NAME],
-        "lastname": row[ExportedOrderCSV.LAST_NAME],
-        "email": row[ExportedOrderCSV.EMAIL] + EMAIL_SUFFIX,
+        "firstname": row.first_name,
+        "lastname": row.last_name,
+        "email": row.email + EMAIL_SUFFIX,
         "phone": "0"
     }
 
@@ -155,21 +519,51 @@ def _generate_checkout(row):
 
 
 def _get_variant_id(row, lightspeed_client):
-    product_ean = row[ExportedOrderCSV.EAN]
+    product_ean = row.ean
 
-    variants = lightspeed_client.get_all_product_variants()
+    variant_index = lightspeed_client.get_variant_index()
 
-    for variant in variants:
-        if variant["ean"] == product_ean:
-            return variant["id"]
+    variant_id = variant_index.get(product_ean)
+    if variant_id is not None:
+        return variant_id
 
     raise ProcessOrderException(f"Cannot find product variant with EAN {product_ean}")
 
 
+def _check_stock(row, variant_id, lightspeed_client):
+    quantity = _parse_quantity(row)
+    if quantity is None or not _is_short(lightspeed_client.get_variant_stock(variant_id), quantity):
+        return
+
+    # The variant index may be outdated, so the shortage is confirmed by the current stock of the variant
+    stock = lightspeed_client.refresh_variant_stock(variant_id)
+    if _is_short(stock, quantity):
+        raise OutOfStockException(f"Product variant with EAN {row.ean} has {stock} items in stock, "
+                                  f"{row.quantity} items are ordered")
+
+
+def _is_short(stock, quantity):
+    return stock is not None and quantity > stock
+
+
+def _reserve_stock(row, variant_id, lightspeed_client):
+    quantity = _parse_quantity(row)
+    if quantity is not None:
+        lightspeed_client.reserve_variant_stock(variant_id, quantity)
+
+
+def _parse_quantity(row):
+    try:
+        return int(row.quantity)
+    except (TypeError, ValueError):
+        # Lightspeed decides on quantities, which cannot be checked locally
+        return None
+
+
 def _generate_product_for_checkout(row, variant_id):
-    product_quantity = row[ExportedOrderCSV.QUANTITY]
-    product_price = row[ExportedOrderCSV.PRICE]
-    country = row[ExportedOrderCSV.COUNTRY]
+    product_quantity = row.quantity
+    product_price = row.price
+    country = row.country
 
     product = {
         "variant_id": variant_id,
@@ -213,23 +607,23 @@ def _generate_payment_status():
 
 
 def _create_order_confirmation(order_id, row):
-    from collections import OrderedDict
     from shared.const.order_statuses import CONFIRMED
 
-    order_dict = OrderedDict()
-    order_dict[OrderConfirmationCSV.ORDER_ID] = order_id
-    order_dict[OrderConfirmationCSV.POSITION_NUM] = row[ExportedOrderCSV.POSITION_NUM]
-    order_dict[OrderConfirmationCSV.QUANTITY] = row[ExportedOrderCSV.QUANTITY]
-    order_dict[OrderConfirmationCSV.STATUS] = CONFIRMED
+    return OrderConfirmation(order_id=order_id,
+                             position_num=row.position_num,
+                             quantity=row.quantity,
+                             status=CONFIRMED)
 
-    return order_dict
 
-
-def run(config_path):
+def run(config_path, config_parser_factory=None, plan_only=False, max_runtime=None):
     """
     Runs the entire application
 
     :param config_path: (str) path to the application config file
+    :param config_parser_factory: (callable) creates ConfigParser from the config path, e.g. a recording or replaying
+    one, defaults to ConfigParser
+    :param plan_only: (bool) if True, only logs the plan of the run without creating any order
+    :param max_runtime: (number) number of seconds the run may take, not limited if None
     :return: exit code 0 if terminated successfully, 1 otherwise
     """
 
@@ -238,7 +632,7 @@ def run(config_path):
     # get values from the config file
     config_parser = None
     try:
-        config_parser = ConfigParser(config_path)
+        config_parser = (config_parser_factory or ConfigParser)(config_path)
     except yaml.YAMLError as e:
         log.critical("Load of config file %s failed. Check correctness of the config file.", config_path)
         return 1
@@ -250,20 +644,73 @@ def run(config_path):
         log.critical(f"Cannot connect to SFTP server. Error message: {e}")
         return 1
 
-    lspeed_client = config_parser.create_lightspeed_client()
+    lspeed_client = config_parser.create_lightspeed_client("lightspeed_offloader")
     if not lspeed_client:
         return 1
 
     config = config_parser.get_config()
     lspeed_shipment_id = config["lightspeed-shipment-id"]
     lspeed_shipment_value_id = config["lightspeed-shipment-value-id"]
+    checkout_mode = config.get("lightspeed-checkout-mode", CHECKOUT_MODE_STEP_BY_STEP)
+    if checkout_mode not in (CHECKOUT_MODE_STEP_BY_STEP, CHECKOUT_MODE_FAST):
+        log.critical(f"Unknown checkout mode '{checkout_mode}'. Check correctness of the config file.")
+        return 1
+
+    run_budget = RunBudget(max_runtime, config.get("run-budget-reserve-seconds", 120)) if max_runtime else None
 
-    # Create temp folder
-    log.debug(f"Creating temp '{TMP_FOLDER}' folder")
-    os.makedirs(TMP_FOLDER, exist_ok=True)
+    # The run budget given on the command line replaces the configured run duration
+    max_run_minutes = config.get("planner-max-run-minutes")
+    max_run_seconds = max_run_minutes * 60 if max_run_minutes else None
+    if run_budget:
+        max_run_seconds = run_budget.get_remaining_seconds()
+    run_limits = planner.RunLimits(config.get("planner-state-path", "./state/planner.json"),
+                                   max_run_seconds,
+                                   config.get("planner-daily-quota-reserve", 0))
 
-    _process_files(sftp_client, lspeed_client, lspeed_shipment_id, lspeed_shipment_value_id)
+    # Plan-only run must not resume any deferred action, since it mustn't change anything in Lightspeed
+    post_finish_queue = None if plan_only else config_parser.create_post_finish_queue(lspeed_client)
 
-    log.debug(f"Removing temp '{TMP_FOLDER}' folder")
-    shutil.rmtree(TMP_FOLDER)
+    file_progress = FileProgress(config.get("offloader-progress-path", "./state/offloader-progress.json"))
+    dedupe_index = DedupeIndex(config.get("dedupe-state-path", "./state/dedupe-index.json"),
+                               config.get("dedupe-horizon-days", 90) * 24 * 60 * 60)
+
+    out_of_stock_policy = config.get("out-of-stock-policy", OUT_OF_STOCK_POLICY_REJECT)
+    if out_of_stock_policy not in (OUT_OF_STOCK_POLICY_REJECT, OUT_OF_STOCK_POLICY_DEFER):
+        log.critical(f"Unknown out-of-stock policy '{out_of_stock_policy}'. Check correctness of the config file.")
+        return 1
+    deferred_rows = None
+    if out_of_stock_policy == OUT_OF_STOCK_POLICY_DEFER:
+        deferred_rows = DeferredRows(config.get("deferred-rows-path", "./state/deferred-rows.json"),
+                                     config.get("deferred-rows-horizon-days", 7) * 24 * 60 * 60)
+    checkout_sweeper = CheckoutSweeper(config.get("orphan-checkouts-path", "./state/orphan-checkouts.json"))
+    checkout_shortcuts = CheckoutShortcuts()
+
+    try:
+        _process_files(sftp_client, lspeed_client, lspeed_shipment_id, lspeed_shipment_value_id, checkout_mode,
+                       post_finish_queue, run_limits, plan_only, file_progress, dedupe_index, run_budget, deferred_rows,
+                       checkout_shortcuts)
+    except (CircuitOpenException, LightspeedUnavailableException) as e:
+        log.critical(f"Lightspeed is unavailable, no file has been processed.\nError: {e}")
+        return 1
+    finally:
+        file_progress.save()
+        if not plan_only:
+            dedupe_index.save()
+            if deferred_rows:
+                deferred_rows.save()
+
+            checkout_sweeper.add(lspeed_client.unfinished_checkouts)
+            with tracing.span("sweep orphan checkouts"):
+                checkout_sweeper.sweep(lspeed_client)
+            checkout_sweeper.save()
+        if post_finish_queue:
+            with tracing.span("wait for post-finish actions"):
+                post_finish_queue.close(run_budget.get_remaining_total_seconds() if run_budget else None)
+        lspeed_client.save_cache()
+
+        call_latency = lspeed_client.get_average_call_latency()
+        if call_latency is not None and not plan_only:
+            planner.save_call_latency(run_limits.state_path, call_latency)
+        if checkout_shortcuts.processed_rows and not plan_only:
+            planner.save_calls_per_row(run_limits.state_path, checkout_mode, checkout_shortcuts.get_calls_per_row())
     return 0
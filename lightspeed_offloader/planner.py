@@ -0,0 +1,188 @@
+"""
+This module contains the planning stage of the offloader run. Before any order is created, input files are read,
+their rows are counted, and the run is estimated from the historical per-call latency and the remaining Lightspeed
+rate-limit quota. Files, which don't fit into the configured run duration or quota, are left on SFTP server for the
+next run.
+"""
+import logging
+from collections import namedtuple
+
+from shared import tracing
+from shared.csv_reader import read_exported_orders
+from shared.exceptions import CSVFormatException
+from shared.state_store import load_state, save_state
+from .dedupe_index import DedupeIndex
+
+"""Per-call latency in seconds assumed until the first run has measured it"""
+DEFAULT_CALL_LATENCY = 0.5
+"""Weight of the latest measured latency in the historical per-call latency"""
+LATENCY_SMOOTHING = 0.3
+
+"""Limits of a single run, max_seconds and quota_reserve may be None if not limited"""
+RunLimits = namedtuple("RunLimits", ["state_path", "max_seconds", "quota_reserve"])
+"""Input file read into memory, so it is downloaded only once, rows and calls omit already submitted rows"""
+PlannedFile = namedtuple("PlannedFile", ["path", "lines", "content_hash", "rows", "orders", "calls"])
+"""Files to process by the current run, deferred files, files with already processed content and the estimate of the
+processed files"""
+RunPlan = namedtuple("RunPlan", ["files", "deferred_files", "duplicate_files", "calls", "seconds", "call_latency",
+                                 "remaining_quota"])
+
+log = logging.getLogger(__name__)
+
+
+def plan_run(sftp_client, lightspeed_client, file_paths, calls_per_row, run_limits: RunLimits = None,
+             dedupe_index=None):
+    """
+    Reads the input files and decides, which of them are processed by the current run. Files with already processed
+    content are set aside before any Lightspeed call, and already submitted rows are not counted. Files are taken in
+    the listed order, until the next one would exceed the run duration, or consume the quota reserved for other
+    applications, e.g. status checker. The first file is always taken if the quota allows it, so a single large file
+    cannot block the input folder forever.
+    :param sftp_client: (SFTPClient) instance of the SFTPClient class
+    :param lightspeed_client: (LightspeedClient) instance of the LightspeedClient class
+    :param file_paths: (list) paths to the input files on SFTP server
+    :param calls_per_row: (number) expected number of Lightspeed calls per row, every row becomes a separate order
+    :param run_limits: (RunLimits) limits of the run, if None, every file is taken
+    :param dedupe_index: (DedupeIndex) processed files and rows, nothing is set aside if None
+    :return: an instance of RunPlan
+    """
+    with tracing.span("download files", files=len(file_paths)):
+        streams = sftp_client.get_files(file_paths)
+
+    files = []
+    duplicate_files = []
+    content_hashes = set()
+    for file_path, stream in zip(file_paths, streams):
+        file = _read_file(file_path, stream, calls_per_row, dedupe_index)
+        if dedupe_index and dedupe_index.get_processed_file(file.content_hash):
+            duplicate_files.append(file)
+            continue
+        if file.content_hash in content_hashes:
+            # The copy is archived once the first file is processed, so it costs no call
+            file = file._replace(calls=0)
+        content_hashes.add(file.content_hash)
+        files.append(file)
+
+    remaining_quota = None
+    if files:
+        # Variant index is needed by every row anyway, fetching it first makes Lightspeed report the remaining quota
+        with tracing.span("get variant index"):
+            lightspeed_client.get_variant_index()
+        remaining_quota = lightspeed_client.get_remaining_daily_quota()
+
+    call_latency = DEFAULT_CALL_LATENCY
+    max_seconds = None
+    available_quota = None
+    if run_limits:
+        call_latency = load_call_latency(run_limits.state_path)
+        max_seconds = run_limits.max_seconds
+        if remaining_quota is not None:
+            available_quota = remaining_quota - (run_limits.quota_reserve or 0)
+
+    planned_files = []
+    deferred_files = []
+    calls = 0
+    for file in files:
+        next_calls = calls + file.calls
+        exceeds_quota = available_quota is not None and next_calls > available_quota
+        exceeds_time = max_seconds is not None and planned_files and next_calls * call_latency > max_seconds
+        if deferred_files or exceeds_quota or exceeds_time:
+            deferred_files.append(file)
+            continue
+
+        planned_files.append(file)
+        calls = next_calls
+
+    return RunPlan(planned_files, deferred_files, duplicate_files, calls, calls * call_latency, call_latency,
+                   remaining_quota)
+
+
+def log_plan(plan: RunPlan):
+    """
+    Logs expected number of calls and duration of the run, and the files left for the next run.
+    :param plan: (RunPlan) plan to log
+    """
+    rows = sum(file.rows for file in plan.files)
+    orders = sum(file.orders for file in plan.files)
+    quota = plan.remaining_quota if plan.remaining_quota is not None else "unknown"
+    log.info(f"Planned {len(plan.files)} files with {rows} rows of {orders} orders: about {plan.calls} Lightspeed "
+             f"calls taking {plan.seconds / 60:.1f} minutes at {plan.call_latency:.2f}s per call, "
+             f"remaining daily quota is {quota}")
+
+    for file in plan.duplicate_files:
+        log.warning(f"File {file.path} has the same content as an already processed file, it is archived without "
+                    f"creating any order")
+
+    for file in plan.deferred_files:
+        log.warning(f"File {file.path} with {file.rows} rows doesn't fit into the run limits, "
+                    f"leaving it for the next run")
+
+
+def load_call_latency(state_path):
+    """
+    Loads historical per-call latency.
+    :param state_path: (str) path to the JSON file with the planner state
+    :return: number of seconds
+    """
+    return load_state(state_path, default={}).get("call_latency", DEFAULT_CALL_LATENCY)
+
+
+def save_call_latency(state_path, measured_latency):
+    """
+    Updates historical per-call latency with the latency measured by the current run.
+    :param state_path: (str) path to the JSON file with the planner state
+    :param measured_latency: (number) average number of seconds per call measured by the current run
+    """
+    state = load_state(state_path, default={})
+    previous_latency = state.get("call_latency")
+    if previous_latency is None:
+        state["call_latency"] = measured_latency
+    else:
+        state["call_latency"] = previous_latency + LATENCY_SMOOTHING * (measured_latency - previous_latency)
+    save_state(state_path, state)
+
+
+def load_calls_per_row(state_path, checkout_mode, default):
+    """
+    Loads number of Lightspeed calls per row observed by the previous run in the checkout mode, e.g. fast checkout
+    shortcuts, which Lightspeed hasn't honored, cost additional calls.
+    :param state_path: (str) path to the JSON file with the planner state
+    :param checkout_mode: (str) checkout mode of the run
+    :param default: (number) number of calls assumed until a run has observed it
+    :return: number of calls per row
+    """
+    return load_state(state_path, default={}).get("calls_per_row", {}).get(checkout_mode, default)
+
+
+def save_calls_per_row(state_path, checkout_mode, calls_per_row):
+    """
+    Saves number of Lightspeed calls per row observed by the current run.
+    :param state_path: (str) path to the JSON file with the planner state
+    :param checkout_mode: (str) checkout mode of the run
+    :param calls_per_row: (number) number of calls per row on the observed path
+    """
+    state = load_state(state_path, default={})
+    state.setdefault("calls_per_row", {})[checkout_mode] = calls_per_row
+    save_state(state_path, state)
+
+
+def _read_file(file_path, file, calls_per_row, dedupe_index=None):
+    try:
+        lines = list(file)
+    finally:
+        file.close()
+
+    content_hash = DedupeIndex.get_content_hash(lines)
+    rows = 0
+    order_ids = set()
+    try:
+        for row in read_exported_orders(lines):
+            if dedupe_index and dedupe_index.is_submitted(row):
+                continue
+            rows += 1
+            order_ids.add(row.order_id)
+    except CSVFormatException:
+        # The file is skipped while processing, and the error is logged there
+        pass
+
+    return PlannedFile(file_path, lines, content_hash, rows, len(order_ids), rows * calls_per_row)
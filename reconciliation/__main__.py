@@ -0,0 +1,111 @@
+import os
+import logging
+import logging.config
+import sys
+import yaml
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from shared import async_logging
+from . import reconciler
+
+
+def _get_parser():
+    """Gets parser object for this script
+
+    :return: an instance of ArgumentParser
+    """
+
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--config",
+                        dest="config",
+                        help="path to configuration file",
+                        type=lambda conf_path: _is_valid_file(parser, conf_path),
+                        required=True)
+    parser.add_argument("-l", "--log-config",
+                        dest="log_config",
+                        help="path to log configuration file",
+                        type=lambda conf_path: _is_valid_file(parser, conf_path),
+                        required=True)
+    parser.add_argument("--from",
+                        dest="date_from",
+                        help="start of the date range in YYYY-MM-DD format, defaults to 30 days ago",
+                        type=lambda date: _parse_date(parser, date),
+                        default=None)
+    parser.add_argument("--to",
+                        dest="date_to",
+                        help="end of the date range in YYYY-MM-DD format, the whole day is included, defaults to now",
+                        type=lambda date: _parse_date(parser, date),
+                        default=None)
+    parser.add_argument("-o", "--output",
+                        dest="output_dir",
+                        help="folder to write the discrepancy report and the repair CSV into, default ./reports",
+                        default="./reports")
+    parser.add_argument("--repair",
+                        dest="repair",
+                        help="write confirmations of the unconfirmed Lightspeed orders into a repair CSV",
+                        action="store_true")
+
+    return parser
+
+
+def _is_valid_file(parser: ArgumentParser, file: str):
+    """Checks if file is valid, and exists on the local file system.
+
+    :param parser: an instance of ArgumentParser
+    :param file: file path to be checked for existence
+    :return: path to file if this file exists on the local file system
+    """
+
+    file = os.path.abspath(file)
+    if not os.path.exists(file):
+        parser.error(f"The file {file} does not exists.")
+    else:
+        return file
+
+
+def _parse_date(parser: ArgumentParser, date: str):
+    """Parses the date argument.
+
+    :param parser: an instance of ArgumentParser
+    :param date: date in YYYY-MM-DD format
+    :return: an instance of datetime
+    """
+
+    try:
+        return datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        parser.error(f"The date {date} is not in YYYY-MM-DD format.")
+
+
+def _setup_logging(path="./config/logging.yaml", default_level=logging.INFO):
+    """Setups logging based on the provided configuration YAML file.
+
+    :param path: (str) path to the log configuration file
+    :param default_level: (int) logging level when no log configuration file is defined
+    """
+
+    if os.path.exists(path):
+        with open(path, "rt") as f:
+            log_config = yaml.safe_load(f.read())
+        async_logging.configure_logging(log_config)
+    else:
+        logging.basicConfig(level=default_level)
+
+
+# Parse script arguments
+args = _get_parser().parse_args()
+
+# Setup logging
+log_config_path = args.log_config
+_setup_logging(path=log_config_path)
+
+# Run app
+app_config_path = args.config
+date_from, date_to = reconciler.get_default_date_range()
+if args.date_from:
+    date_from = args.date_from
+if args.date_to:
+    date_to = args.date_to + timedelta(days=1) - timedelta(seconds=1)
+
+exit_code = reconciler.run(app_config_path, date_from, date_to, args.output_dir, args.repair)
+sys.exit(exit_code)
@@ -0,0 +1,293 @@
+"""
+This module contains a bulk reconciliation job, which compares order confirmations on SFTP server with the orders
+Lightspeed has actually recorded. Instead of checking the orders one by one, Lightspeed orders of the date range are
+fetched page by page, and both sides are joined by the order id in memory.
+
+The result is a discrepancy report, and optionally a repair CSV with confirmations of the orders, which exist in
+Lightspeed, but have never been confirmed to the partner.
+"""
+import csv
+import logging
+import os
+from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+
+from lightspeed_offloader.offloader import EMAIL_SUFFIX
+from shared import csv_writer, tracing
+from shared.const import order_statuses
+from shared.const.csv_column_names import OrderConfirmationCSV
+from shared.csv_reader import OrderConfirmation, read_exported_orders, read_order_confirmations
+from shared.exceptions import CSVFormatException
+
+"""Order is confirmed to the partner, but Lightspeed has no such order"""
+MISSING_IN_LIGHTSPEED = "missing_in_lightspeed"
+"""Order is confirmed to the partner, but it hasn't been paid in Lightspeed"""
+NOT_PAID = "not_paid"
+"""Order is confirmed to the partner, but it has been cancelled in Lightspeed"""
+CANCELLED = "cancelled"
+"""Order has been created in Lightspeed, but it has never been confirmed to the partner"""
+NOT_CONFIRMED = "not_confirmed"
+"""Order has been shipped in Lightspeed, but the shipment hasn't been reported to the partner yet"""
+SHIPMENT_NOT_REPORTED = "shipment_not_reported"
+
+"""Time format of Lightspeed created_at filters"""
+LIGHTSPEED_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+"""Number of seconds before the date range, which archived files are read for, exports are uploaded before their
+orders are created"""
+FILE_LOOKBACK = 7 * 24 * 60 * 60
+
+"""A single row of the discrepancy report"""
+Discrepancy = namedtuple("Discrepancy", ["kind", "order_id", "lightspeed_status", "payment_status", "details"])
+REPORT_FIELDNAMES = list(Discrepancy._fields)
+
+"""Order confirmations and exported orders found on SFTP server"""
+LocalSnapshot = namedtuple("LocalSnapshot", ["confirmations", "exported_rows"])
+
+log = logging.getLogger(__name__)
+
+
+def reconcile(sftp_client, lspeed_client, date_from: datetime, date_to: datetime):
+    """
+    Fetches Lightspeed orders created within the date range, and diffs them against order confirmations and exported
+    orders found in the output and archive folders.
+    :param sftp_client: (SFTPClient) instance of the SFTPClient class
+    :param lspeed_client: (LightspeedClient) instance of the LightspeedClient class
+    :param date_from: (datetime) start of the date range
+    :param date_to: (datetime) end of the date range
+    :return: (discrepancies, repair_confirmations) tuple of lists
+    """
+    with tracing.span("get lightspeed orders"):
+        lspeed_orders = lspeed_client.get_orders_created_between(date_from.strftime(LIGHTSPEED_TIME_FORMAT),
+                                                                 date_to.strftime(LIGHTSPEED_TIME_FORMAT))
+    log.info(f"Fetched {len(lspeed_orders)} Lightspeed orders created between {date_from} and {date_to}.")
+
+    with tracing.span("read local files"):
+        snapshot = read_local_snapshot(sftp_client, date_from.timestamp() - FILE_LOOKBACK)
+    log.info(f"Read {len(snapshot.confirmations)} confirmed orders and exported orders of "
+             f"{len(snapshot.exported_rows)} partner orders.")
+
+    return diff_orders(lspeed_orders, snapshot)
+
+
+def read_local_snapshot(sftp_client, modified_since=None):
+    """
+    Reads files of the output and archive folders. Order confirmation files are recognized by their header, every
+    other file is parsed as exported orders.
+    :param sftp_client: (SFTPClient) instance of the SFTPClient class
+    :param modified_since: (number) seconds since the epoch, older archived files are omitted if set
+    :return: an instance of LocalSnapshot
+    """
+    file_paths = sftp_client.list_output_files() + sftp_client.list_archived_files(modified_since)
+    with tracing.span("download files", files=len(file_paths)):
+        files = sftp_client.get_files(file_paths)
+
+    confirmations = {}
+    exported_rows = defaultdict(list)
+    for file_path, file in zip(file_paths, files):
+        try:
+            lines = list(file)
+        finally:
+            file.close()
+
+        try:
+            for row in read_order_confirmations(lines):
+                confirmations[row.order_id] = _get_latest_confirmation(confirmations.get(row.order_id), row)
+            continue
+        except CSVFormatException:
+            pass
+
+        try:
+            for row in read_exported_orders(lines):
+                exported_rows[row.email].append(row)
+        except CSVFormatException as e:
+            log.warning(f"Cannot parse file {file_path}, skipping it.\nError: {e}")
+
+    return LocalSnapshot(confirmations, exported_rows)
+
+
+def diff_orders(lspeed_orders, snapshot: LocalSnapshot):
+    """
+    Joins Lightspeed orders with the local confirmations by order id, and reports every order, which state differs.
+    Orders of other sales channels, i.e. without the offloader email suffix, are ignored. Confirmations are checked for
+    a missing Lightspeed order only within the fetched id range, since the rest of them belongs to other dates.
+    :param lspeed_orders: (list) Lightspeed order objects with 'id', 'status', 'paymentStatus' and 'email' fields
+    :param snapshot: (LocalSnapshot) order confirmations and exported orders
+    :return: (discrepancies, repair_confirmations) tuple of lists
+    """
+    orders_by_id = {str(order["id"]): order for order in lspeed_orders}
+    own_orders = {order_id: order for order_id, order in orders_by_id.items()
+                  if (order.get("email") or "").endswith(EMAIL_SUFFIX)}
+
+    discrepancies = []
+    unconfirmed_orders = defaultdict(list)
+    for order_id, order in own_orders.items():
+        confirmation = snapshot.confirmations.get(order_id)
+        if not confirmation:
+            partner_order_id = order["email"][:-len(EMAIL_SUFFIX)]
+            unconfirmed_orders[partner_order_id].append(order)
+            continue
+
+        if order.get("status") == "cancelled":
+            discrepancies.append(_create_discrepancy(CANCELLED, order, f"confirmed as {confirmation.status}"))
+        elif order.get("paymentStatus") != "paid":
+            discrepancies.append(_create_discrepancy(NOT_PAID, order, f"confirmed as {confirmation.status}"))
+        elif order.get("status") == "completed_shipped" and confirmation.status == order_statuses.CONFIRMED:
+            discrepancies.append(_create_discrepancy(SHIPMENT_NOT_REPORTED, order,
+                                                     "status checker hasn't reported the shipment yet"))
+
+    order_ids = [int(order_id) for order_id in orders_by_id if order_id.isdigit()]
+    if order_ids:
+        min_id, max_id = min(order_ids), max(order_ids)
+        for order_id, confirmation in snapshot.confirmations.items():
+            if order_id.isdigit() and min_id <= int(order_id) <= max_id and order_id not in orders_by_id:
+                discrepancies.append(Discrepancy(MISSING_IN_LIGHTSPEED, order_id, None, None,
+                                                 f"confirmed as {confirmation.status}"))
+
+    repair_confirmations = []
+    for partner_order_id, orders in unconfirmed_orders.items():
+        positions = _get_unconfirmed_positions(partner_order_id, orders_by_id, snapshot)
+        if len(orders) == 1 and len(positions) == 1:
+            row = positions[0]
+            repair_confirmations.append(OrderConfirmation(order_id=str(orders[0]["id"]),
+                                                          position_num=row.position_num,
+                                                          quantity=row.quantity,
+                                                          status=order_statuses.CONFIRMED))
+            details = f"partner order {partner_order_id}, position {row.position_num}, repair confirmation created"
+        else:
+            details = (f"partner order {partner_order_id}, {len(orders)} unconfirmed Lightspeed orders for "
+                       f"{len(positions)} unconfirmed positions, cannot be repaired automatically")
+
+        for order in orders:
+            discrepancies.append(_create_discrepancy(NOT_CONFIRMED, order, details))
+
+    return discrepancies, repair_confirmations
+
+
+def write_report(output_dir, discrepancies, repair_confirmations, date_from: datetime, date_to: datetime):
+    """
+    Writes the discrepancy report, and the repair CSV if there is anything to repair, into the output folder.
+    :param output_dir: (str) path to the local folder
+    :param discrepancies: (list) Discrepancy records
+    :param repair_confirmations: (list) OrderConfirmation records
+    :param date_from: (datetime) start of the reconciled date range
+    :param date_to: (datetime) end of the reconciled date range
+    :return: a list of paths to the written files
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    report_path = os.path.join(output_dir, f"reconciliation-{date_from:%Y%m%d}-{date_to:%Y%m%d}.csv")
+    with open(report_path, "w", newline="", encoding="utf-8") as report:
+        writer = csv.writer(report, dialect=csv_writer.CSV_DIALECT_NAME)
+        writer.writerow(REPORT_FIELDNAMES)
+        writer.writerows(sorted(discrepancies, key=lambda discrepancy: (discrepancy.kind, discrepancy.order_id)))
+    written_files = [report_path]
+
+    if repair_confirmations:
+        file_name, content = csv_writer.serialize_orders_as_csv(repair_confirmations, OrderConfirmationCSV.FIELDNAMES)
+        repair_path = os.path.join(output_dir, file_name)
+        with open(repair_path, "wb") as repair:
+            repair.write(content)
+        written_files.append(repair_path)
+
+    return written_files
+
+
+def log_summary(discrepancies, repair_confirmations):
+    counts = defaultdict(int)
+    for discrepancy in discrepancies:
+        counts[discrepancy.kind] += 1
+
+    if not discrepancies:
+        log.info("No discrepancy has been found.")
+        return
+
+    summary = ", ".join(f"{count} {kind}" for kind, count in sorted(counts.items()))
+    log.warning(f"Found {len(discrepancies)} discrepancies: {summary}. "
+                f"{len(repair_confirmations)} orders can be repaired.")
+
+
+def _get_latest_confirmation(previous: OrderConfirmation, row: OrderConfirmation):
+    # Shipped and returned records are created from the confirmed one, so they win regardless of the file order
+    if previous is None or previous.status == order_statuses.CONFIRMED:
+        return row
+    if previous.status == order_statuses.SHIPPED and row.status == order_statuses.RETURNED:
+        return row
+    return previous
+
+
+def _get_unconfirmed_positions(partner_order_id, orders_by_id, snapshot: LocalSnapshot):
+    """
+    Every exported row becomes a separate Lightspeed order with the same email, so the position of an unconfirmed
+    order is found by excluding positions confirmed by the other Lightspeed orders of the same partner order.
+    :return: a list of ExportedOrder records
+    """
+    confirmed_positions = set()
+    for order_id, confirmation in snapshot.confirmations.items():
+        order = orders_by_id.get(order_id)
+        if order and order.get("email") == partner_order_id + EMAIL_SUFFIX:
+            confirmed_positions.add(confirmation.position_num)
+
+    return [row for row in snapshot.exported_rows.get(partner_order_id, [])
+            if row.position_num not in confirmed_positions]
+
+
+def _create_discrepancy(kind, order, details):
+    return Discrepancy(kind, str(order["id"]), order.get("status"), order.get("paymentStatus"), details)
+
+
+def get_default_date_range(days=30):
+    """
+    :param days: (number) number of days to reconcile
+    :return: (date_from, date_to) tuple, the range ends now
+    """
+    date_to = datetime.now()
+    return date_to - timedelta(days=days), date_to
+
+
+def run(config_path, date_from: datetime, date_to: datetime, output_dir, repair=False, config_parser_factory=None):
+    """
+    Runs the reconciliation job.
+    :param config_path: (str) path to the application config file
+    :param date_from: (datetime) start of the date range
+    :param date_to: (datetime) end of the date range
+    :param output_dir: (str) path to the local folder to write the report and the repair CSV into
+    :param repair: (bool) if True, confirmations of the unconfirmed orders are written into a repair CSV
+    :param config_parser_factory: (callable) creates ConfigParser from the config path, defaults to ConfigParser
+    :return: exit code 0 if no discrepancy has been found, 2 if some have been found, 1 on failure
+    """
+    from yaml import YAMLError
+    from paramiko.ssh_exception import SSHException
+    from shared.config_parser import ConfigParser
+    from shared.exceptions import CircuitOpenException, UnexpectedHTTPStatusCodeException
+
+    try:
+        config_parser = (config_parser_factory or ConfigParser)(config_path)
+    except YAMLError:
+        log.critical(f"Failed to load config file {config_path}. Check the correctness of the config.")
+        return 1
+
+    try:
+        sftp_client = config_parser.create_sftp_client()
+    except SSHException as e:
+        log.critical(f"Cannot connect to SFTP server. Error message: {e}")
+        return 1
+
+    lspeed_client = config_parser.create_lightspeed_client("reconciliation")
+    if not lspeed_client or not sftp_client:
+        return 1
+
+    try:
+        discrepancies, repair_confirmations = reconcile(sftp_client, lspeed_client, date_from, date_to)
+    except (CircuitOpenException, UnexpectedHTTPStatusCodeException) as e:
+        log.critical(f"Failed to fetch Lightspeed orders.\nError: {e}")
+        return 1
+    finally:
+        sftp_client.close()
+
+    log_summary(discrepancies, repair_confirmations)
+    repair_confirmations = repair_confirmations if repair else []
+    for file_path in write_report(output_dir, discrepancies, repair_confirmations, date_from, date_to):
+        log.info(f"Written {file_path}")
+
+    return 2 if discrepancies else 0
+
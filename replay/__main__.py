@@ -0,0 +1,121 @@
+import functools
+import os
+import logging
+import logging.config
+import sys
+import time
+import yaml
+from argparse import ArgumentParser
+from shared import async_logging, tracing
+from .bundle import Bundle
+from .replaying import ReplayConfigParser
+
+"""Modules which can be replayed"""
+MODULES = ("lightspeed_offloader", "status_checker")
+
+log = logging.getLogger(__name__)
+
+
+def _get_parser():
+    """Gets parser object for this script
+
+    :return: an instance of ArgumentParser
+    """
+
+    parser = ArgumentParser(description="Replays a recorded run of lightspeed_offloader or status_checker")
+    parser.add_argument("-c", "--config",
+                        dest="config",
+                        help="path to configuration file",
+                        type=lambda conf_path: _is_valid_path(parser, conf_path),
+                        required=True)
+    parser.add_argument("-l", "--log-config",
+                        dest="log_config",
+                        help="path to log configuration file",
+                        type=lambda conf_path: _is_valid_path(parser, conf_path),
+                        required=True)
+    parser.add_argument("-b", "--bundle",
+                        dest="bundle",
+                        help="path to the bundle recorded with --record option",
+                        type=lambda bundle_path: _is_valid_path(parser, bundle_path),
+                        required=True)
+    parser.add_argument("-m", "--module",
+                        dest="module",
+                        help="module to replay",
+                        choices=MODULES,
+                        required=True)
+    parser.add_argument("--speed",
+                        dest="speed",
+                        help="factor applied to the recorded latencies, 1 replays original latencies, 0 none",
+                        type=float,
+                        default=1.0)
+    parser.add_argument("--scale",
+                        dest="scale",
+                        help="number of copies of every recorded order",
+                        type=int,
+                        default=1)
+    parser.add_argument("--profile",
+                        dest="profile_dir",
+                        help="folder to store JSON trace, cProfile stats and per-row timing breakdown into",
+                        default=None)
+
+    return parser
+
+
+def _is_valid_path(parser: ArgumentParser, path: str):
+    """Checks if path exists on the local file system.
+
+    :param parser: an instance of ArgumentParser
+    :param path: path to be checked for existence
+    :return: absolute path if it exists on the local file system
+    """
+
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        parser.error(f"The path {path} does not exists.")
+    else:
+        return path
+
+
+def _setup_logging(path, default_level=logging.INFO):
+    """Setups logging based on the provided configuration YAML file.
+
+    :param path: (str) path to the log configuration file
+    :param default_level: (int) logging level when no log configuration file is defined
+    """
+
+    if os.path.exists(path):
+        with open(path, "rt") as f:
+            log_config = yaml.safe_load(f.read())
+        async_logging.configure_logging(log_config)
+    else:
+        logging.basicConfig(level=default_level)
+
+
+# Parse script arguments
+args = _get_parser().parse_args()
+
+# Setup logging
+_setup_logging(path=args.log_config)
+
+if args.module == "lightspeed_offloader":
+    from lightspeed_offloader import offloader as replayed_module
+else:
+    from status_checker import checker as replayed_module
+
+config_parser_factory = functools.partial(ReplayConfigParser, bundle_path=args.bundle, speed=args.speed,
+                                          scale=args.scale)
+
+profile_dir = os.path.abspath(args.profile_dir) if args.profile_dir else None
+
+# Relative paths used by default, e.g. for state files, are resolved within the replay folder of the bundle, which is
+# emptied first, so state of the previous replay, e.g. dedupe index or learned latency, doesn't affect this one
+replay_dir = Bundle(args.bundle).reset_replay_folder()
+os.chdir(replay_dir)
+
+# Run app
+start = time.perf_counter()
+with tracing.profiling(profile_dir, f"replay-{args.module}"):
+    exit_code = replayed_module.run(args.config, config_parser_factory)
+log.info(f"Replay of {args.module} with speed {args.speed} and scale {args.scale} "
+         f"has finished in {time.perf_counter() - start:.2f} s")
+sys.exit(exit_code)
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import threading
+
+"""File with recorded Lightspeed HTTP exchanges, one JSON object per line"""
+HTTP_FILE = "http.jsonl"
+"""File with recorded SFTP operations, one JSON object per line"""
+SFTP_FILE = "sftp.jsonl"
+"""Folder with recorded files of SFTP input folder, i.e. exported orders"""
+INPUT_FOLDER = "input"
+"""Folder with recorded files of SFTP output folder, i.e. order confirmations"""
+OUTPUT_FOLDER = "output"
+"""Folder used as working directory and SFTP server by the replay"""
+REPLAY_FOLDER = "replay"
+
+
+class Bundle:
+    """
+    Replay bundle, i.e. a folder with recorded Lightspeed HTTP exchanges, SFTP operations and SFTP file contents.
+
+    :param path: (str) path to the bundle folder
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+
+    def add_http_exchange(self, exchange: dict):
+        self._append(HTTP_FILE, exchange)
+
+    def add_sftp_operation(self, operation: dict):
+        self._append(SFTP_FILE, operation)
+
+    def add_file(self, folder: str, file_name: str, content: str):
+        """
+        Stores content of the SFTP file.
+        :param folder: (str) either INPUT_FOLDER or OUTPUT_FOLDER
+        :param file_name: (str) name of the file
+        :param content: (str) scrubbed file content
+        """
+        folder_path = os.path.join(self.path, folder)
+        os.makedirs(folder_path, exist_ok=True)
+        with open(os.path.join(folder_path, file_name), "wt", encoding="utf8", newline="") as f:
+            f.write(content)
+
+    def load_http_exchanges(self):
+        return self._load(HTTP_FILE)
+
+    def load_sftp_operations(self):
+        return self._load(SFTP_FILE)
+
+    def load_files(self, folder: str):
+        """
+        Loads recorded SFTP files.
+        :param folder: (str) either INPUT_FOLDER or OUTPUT_FOLDER
+        :return: dictionary mapping file name to its content
+        """
+        folder_path = os.path.join(self.path, folder)
+        if not os.path.isdir(folder_path):
+            return {}
+
+        files = {}
+        for file_name in sorted(os.listdir(folder_path)):
+            with open(os.path.join(folder_path, file_name), "rt", encoding="utf8", newline="") as f:
+                files[file_name] = f.read()
+        return files
+
+    def reset_replay_folder(self):
+        """
+        Removes state files, uploaded and archived files of the previous replay, so every replay starts from
+        the recorded bundle only.
+        :return: (str) path to the empty replay folder
+        """
+        replay_path = os.path.join(self.path, REPLAY_FOLDER)
+        shutil.rmtree(replay_path, ignore_errors=True)
+        os.makedirs(replay_path)
+        return replay_path
+
+    def get_replay_path(self, *parts):
+        path = os.path.join(self.path, REPLAY_FOLDER, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _append(self, file_name, record):
+        line = json.dumps(record)
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, file_name), "at", encoding="utf8") as f:
+                f.write(line + "\n")
+
+    def _load(self, file_name):
+        path = os.path.join(self.path, file_name)
+        if not os.path.exists(path):
+            return []
+
+        with open(path, "rt", encoding="utf8") as f:
+            return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,151 @@
+import io
+import json
+import logging
+import os
+import time
+
+from shared.config_parser import ConfigParser
+from .bundle import Bundle, INPUT_FOLDER, OUTPUT_FOLDER
+from .scrubbing import scrub_csv, scrub_json
+
+"""Response headers kept in the recording, the rest of the headers is dropped"""
+RECORDED_HEADERS = ("ETag", "Last-Modified", "X-RateLimit-Limit", "X-RateLimit-Remaining", "X-RateLimit-Reset")
+
+log = logging.getLogger(__name__)
+
+
+class RecordingHttp:
+    """
+    Wraps requests module interface, and records every Lightspeed HTTP exchange into the bundle. Request headers and
+    bodies are never recorded, since they contain credentials and personal data, response bodies are scrubbed.
+
+    :param http: object providing get, post, put and delete functions, usually the requests module
+    :param bundle: (Bundle) bundle to record into
+    :param api_url: (str) Lightspeed base URL, which is stripped from the recorded URLs
+    """
+
+    def __init__(self, http, bundle: Bundle, api_url: str):
+        self.http = http
+        self.bundle = bundle
+        self.api_url = api_url
+
+    def get(self, url, **kwargs):
+        return self._record("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._record("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._record("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._record("DELETE", url, **kwargs)
+
+    def _record(self, method, url, **kwargs):
+        start = time.perf_counter()
+        response = getattr(self.http, method.lower())(url, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        try:
+            body = scrub_json(json.loads(response.content))
+        except ValueError:
+            body = None
+
+        params = kwargs.get("params") or {}
+        self.bundle.add_http_exchange({
+            "method": method,
+            "path": url[len(self.api_url):] if url.startswith(self.api_url) else url,
+            "params": {key: str(value) for key, value in params.items()},
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers},
+            "body": body,
+            "elapsed": elapsed
+        })
+        return response
+
+
+class RecordingSFTPClient:
+    """
+    Wraps SFTPClient, and records performed operations with their duration, and scrubbed content of the read files
+    into the bundle.
+
+    :param sftp_client: (SFTPClient) client to wrap
+    :param bundle: (Bundle) bundle to record into
+    """
+
+    def __init__(self, sftp_client, bundle: Bundle):
+        self.sftp_client = sftp_client
+        self.bundle = bundle
+
+    def __getattr__(self, name):
+        return getattr(self.sftp_client, name)
+
+    def list_input_files(self):
+        return self._timed("list_input_files", self.sftp_client.list_input_files)
+
+    def list_output_files(self):
+        return self._timed("list_output_files", self.sftp_client.list_output_files)
+
+    def get_file(self, path):
+        """
+        Reads the whole file, records its scrubbed content, and returns the original content.
+        :param path: (str) absolute path to the file on SFTP server
+        :return: file-like object with the file content
+        """
+
+        def read_file():
+            file = self.sftp_client.get_file(path)
+            try:
+                content = file.read()
+            finally:
+                file.close()
+            return content.decode("utf-8") if isinstance(content, bytes) else content
+
+        content = self._timed("get_file", read_file)
+
+        folder = INPUT_FOLDER if os.path.dirname(path) == self.sftp_client.input_dir.rstrip("/") else OUTPUT_FOLDER
+        self.bundle.add_file(folder, os.path.basename(path), scrub_csv(content))
+
+        return io.StringIO(content, newline="")
+
+    def get_files(self, paths):
+        return [self.get_file(path) for path in paths]
+
+    def archive_file(self, path):
+        return self._timed("archive_file", self.sftp_client.archive_file, path)
+
+    def upload_processed_orders(self, file_name, content):
+        return self._timed("upload_processed_orders", self.sftp_client.upload_processed_orders, file_name, content)
+
+    def _timed(self, operation, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.bundle.add_sftp_operation({"operation": operation, "elapsed": time.perf_counter() - start})
+        return result
+
+
+class RecordingConfigParser(ConfigParser):
+    """
+    ConfigParser creating clients, which record the run into a replay bundle.
+
+    :param config_path: (str) path to the application config file
+    :param bundle_path: (str) path to the bundle folder
+    """
+
+    def __init__(self, config_path, bundle_path):
+        super().__init__(config_path)
+        self.bundle = Bundle(bundle_path)
+        log.info(f"Recording the run into {self.bundle.path}")
+
+    def create_sftp_client(self):
+        sftp_client = super().create_sftp_client()
+        if not sftp_client:
+            return None
+        return RecordingSFTPClient(sftp_client, self.bundle)
+
+    def create_lightspeed_client(self, module_name=None):
+        lightspeed_client = super().create_lightspeed_client(module_name)
+        if not lightspeed_client:
+            return None
+        lightspeed_client.http = RecordingHttp(lightspeed_client.http, self.bundle, lightspeed_client.api_url)
+        return lightspeed_client
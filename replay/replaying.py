@@ -0,0 +1,235 @@
+import csv
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+from requests.structures import CaseInsensitiveDict
+
+from shared.config_parser import ConfigParser
+from .bundle import Bundle, INPUT_FOLDER, OUTPUT_FOLDER
+
+"""Base URL of the replayed Lightspeed API"""
+REPLAY_API_URL = "replay://lightspeed"
+"""Column holding order id in both exported orders and order confirmation files"""
+ORDER_ID_COLUMN = "Belegnummer"
+"""Suffix added to the order ids of the duplicated rows"""
+DUPLICATE_SUFFIX_PATTERN = re.compile(r"-dup\d+")
+"""Numeric path segments, e.g. checkout or order ids"""
+ID_SEGMENT_PATTERN = re.compile(r"/\d+(?=[/.])")
+"""Config properties with paths, which must not be redirected into the replay folder"""
+SECRET_PATH_KEYS = ("sftp-pass-path", "lightspeed-api-secret-path")
+
+log = logging.getLogger(__name__)
+
+
+class ReplayResponse:
+    """
+    Minimal replacement of requests.Response built from a recorded exchange.
+    """
+
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = json.dumps(body).encode("utf-8") if body is not None else b""
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ReplayHttp:
+    """
+    Serves recorded Lightspeed HTTP exchanges instead of sending requests. A request is matched by method, path and
+    query parameters first, and then by method and path with ids replaced, e.g. '/checkouts/{id}/order.json'.
+    Matched exchanges are served round-robin, so duplicated orders get responses too.
+
+    :param exchanges: (list) recorded exchanges
+    :param speed: (number) factor applied to the recorded latencies, 0 replays without any latency
+    """
+
+    def __init__(self, exchanges, speed=1.0):
+        self.speed = speed
+        self._exchanges = defaultdict(list)
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self.served_exchanges = 0
+
+        for exchange in exchanges:
+            exact_key = self._get_exact_key(exchange["method"], exchange["path"], exchange["params"])
+            self._exchanges[exact_key].append(exchange)
+            self._exchanges[self._get_normalized_key(exchange["method"], exchange["path"])].append(exchange)
+
+    def get(self, url, **kwargs):
+        return self._respond("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._respond("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self._respond("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self._respond("DELETE", url, **kwargs)
+
+    def _respond(self, method, url, headers=None, params=None, **kwargs):
+        path = DUPLICATE_SUFFIX_PATTERN.sub("", url[len(REPLAY_API_URL):])
+        params = {key: DUPLICATE_SUFFIX_PATTERN.sub("", str(value)) for key, value in (params or {}).items()}
+
+        conditional = headers and ("If-None-Match" in headers or "If-Modified-Since" in headers)
+        exact_key = self._get_exact_key(method, path, params)
+        normalized_key = self._get_normalized_key(method, path)
+
+        exchange = self._pick(exact_key, conditional) or self._pick(normalized_key, conditional)
+        if exchange is None:
+            log.warning(f"No recorded exchange for {method} {path} {params}")
+            return ReplayResponse(404, {}, {"error": "not recorded"})
+
+        if self.speed:
+            time.sleep(exchange["elapsed"] * self.speed)
+
+        return ReplayResponse(exchange["status"], exchange["headers"], exchange["body"])
+
+    def _pick(self, key, conditional):
+        exchanges = self._exchanges.get(key)
+        if not exchanges:
+            return None
+
+        # 304 responses can only be served to conditional requests
+        if not conditional:
+            exchanges = [exchange for exchange in exchanges if exchange["status"] != 304] or exchanges
+
+        with self._lock:
+            index = self._counters[key]
+            self._counters[key] += 1
+            self.served_exchanges += 1
+        return exchanges[index % len(exchanges)]
+
+    @staticmethod
+    def _get_exact_key(method, path, params):
+        return "exact", method, path, tuple(sorted(params.items()))
+
+    @staticmethod
+    def _get_normalized_key(method, path):
+        return "normalized", method, ID_SEGMENT_PATTERN.sub("/{id}", path)
+
+
+class ReplaySFTPClient:
+    """
+    In-memory replacement of SFTPClient serving recorded files. Every row is duplicated 'scale' times, the
+    duplicates get '-dup<number>' suffix of the order id. Uploaded and archived files are stored into the replay
+    folder of the bundle.
+
+    :param bundle: (Bundle) recorded bundle
+    :param speed: (number) factor applied to the recorded latencies, 0 replays without any latency
+    :param scale: (number) number of copies of every recorded row
+    """
+
+    def __init__(self, bundle: Bundle, speed=1.0, scale=1):
+        self.bundle = bundle
+        self.speed = speed
+        self.input_dir = INPUT_FOLDER
+        self.output_dir = OUTPUT_FOLDER
+        self._files = {}
+        for folder in (INPUT_FOLDER, OUTPUT_FOLDER):
+            for file_name, content in bundle.load_files(folder).items():
+                self._files[os.path.join(folder, file_name)] = _scale_rows(content, scale)
+
+        latencies = defaultdict(list)
+        for operation in bundle.load_sftp_operations():
+            latencies[operation["operation"]].append(operation["elapsed"])
+        self._latencies = {operation: sum(values) / len(values) for operation, values in latencies.items()}
+
+    def list_input_files(self):
+        self._wait("list_input_files")
+        return sorted(path for path in self._files if os.path.dirname(path) == INPUT_FOLDER)
+
+    def list_output_files(self):
+        self._wait("list_output_files")
+        return sorted(path for path in self._files if os.path.dirname(path) == OUTPUT_FOLDER)
+
+    def get_file(self, path):
+        self._wait("get_file")
+        return io.StringIO(self._files[path], newline="")
+
+    def get_files(self, paths):
+        return [self.get_file(path) for path in paths]
+
+    def archive_file(self, path):
+        self._wait("archive_file")
+        content = self._files.pop(path)
+        self._save("archive", os.path.basename(path), content.encode("utf-8"))
+
+    def upload_processed_orders(self, file_name, content):
+        self._wait("upload_processed_orders")
+        return self._save("uploads", file_name, content)
+
+    def _save(self, folder, file_name, content: bytes):
+        path = self.bundle.get_replay_path(folder, file_name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def _wait(self, operation):
+        if self.speed:
+            time.sleep(self._latencies.get(operation, 0) * self.speed)
+
+
+class ReplayConfigParser(ConfigParser):
+    """
+    ConfigParser creating clients, which replay the recorded bundle instead of talking to SFTP and Lightspeed.
+    Every configured local path, e.g. state files, is redirected into the replay folder of the bundle.
+
+    :param config_path: (str) path to the application config file
+    :param bundle_path: (str) path to the bundle folder
+    :param speed: (number) factor applied to the recorded latencies, 0 replays without any latency
+    :param scale: (number) number of copies of every recorded row
+    """
+
+    def __init__(self, config_path, bundle_path, speed=1.0, scale=1):
+        super().__init__(config_path)
+        self.bundle = Bundle(bundle_path)
+        self.speed = speed
+        self.scale = scale
+        self.http = ReplayHttp(self.bundle.load_http_exchanges(), speed)
+
+        for key, value in list(self.config.items()):
+            if key.endswith("-path") and key not in SECRET_PATH_KEYS and value:
+                self.config[key] = self.bundle.get_replay_path("state", os.path.basename(value))
+
+    def create_sftp_client(self):
+        return ReplaySFTPClient(self.bundle, self.speed, self.scale)
+
+    def create_lightspeed_client(self, module_name=None):
+        from shared.lightspeed_client import DEFAULT_VARIANTS_MAX_AGE, LightspeedClient
+
+        variants_max_age = self.config.get("lightspeed-variants-max-age", DEFAULT_VARIANTS_MAX_AGE)
+        return LightspeedClient(REPLAY_API_URL, "replay", "replay", self.create_response_cache(module_name),
+                                variants_max_age, http=self.http, circuit_breaker=self.create_circuit_breaker())
+
+
+def _scale_rows(content: str, scale: int):
+    if scale <= 1:
+        return content
+
+    rows = list(csv.reader(io.StringIO(content), delimiter=";"))
+    if not rows or ORDER_ID_COLUMN not in rows[0]:
+        return content
+
+    order_id_index = rows[0].index(ORDER_ID_COLUMN)
+    scaled_rows = [rows[0]]
+    for row in rows[1:]:
+        scaled_rows.append(row)
+        for copy in range(1, scale):
+            duplicate = list(row)
+            if order_id_index < len(duplicate):
+                duplicate[order_id_index] = f"{duplicate[order_id_index]}-dup{copy}"
+            scaled_rows.append(duplicate)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";", lineterminator="\n")
+    writer.writerows(scaled_rows)
+    return buffer.getvalue()
@@ -0,0 +1,76 @@
+"""
+This module contains helpers to remove personal data from recorded Lightspeed responses and SFTP files.
+Scrubbed values are replaced with deterministic tokens, so equal values stay equal after scrubbing.
+"""
+import csv
+import hashlib
+import io
+import re
+
+from shared.const.csv_column_names import ExportedOrderCSV
+
+"""JSON keys of Lightspeed resources, which may contain personal data"""
+PII_KEY_PATTERN = re.compile(r"(?i)^(.*name|.*e-?mail|phone|mobile|address.*|street.*|number|zipcode|city|company.*|"
+                             r"remoteip|customer.*|vat.*|coc.*|birthdate)$")
+
+"""Columns of exported orders CSV file, which contain personal data"""
+PII_CSV_COLUMNS = {ExportedOrderCSV.FIRST_NAME, ExportedOrderCSV.LAST_NAME, ExportedOrderCSV.ADDRESS_STREET,
+                   ExportedOrderCSV.ADDRESS_HOUSE, ExportedOrderCSV.COMPANY, ExportedOrderCSV.ZIP,
+                   ExportedOrderCSV.CITY}
+
+
+def scrub_value(value):
+    """
+    Replaces a value with a deterministic token.
+    :param value: value to scrub
+    :return: token, or the value itself if it is empty
+    """
+    if value is None or value == "" or isinstance(value, bool):
+        return value
+    return "x" + hashlib.sha1(str(value).encode("utf-8")).hexdigest()[:10]
+
+
+def scrub_json(data):
+    """
+    Recursively scrubs values of the keys, which may contain personal data. Nested objects under such keys are
+    scrubbed as a whole, i.e. each of their leaf values is replaced with a token.
+    :param data: decoded JSON document
+    :return: scrubbed copy of the document
+    """
+    if isinstance(data, dict):
+        return {key: _scrub_all(value) if PII_KEY_PATTERN.match(key) else scrub_json(value)
+                for key, value in data.items()}
+    if isinstance(data, list):
+        return [scrub_json(item) for item in data]
+    return data
+
+
+def _scrub_all(data):
+    if isinstance(data, dict):
+        return {key: _scrub_all(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_scrub_all(item) for item in data]
+    return scrub_value(data)
+
+
+def scrub_csv(content: str, delimiter=";"):
+    """
+    Scrubs columns of the CSV file, which contain personal data.
+    :param content: (str) CSV file content
+    :param delimiter: (str) CSV delimiter
+    :return: scrubbed CSV file content
+    """
+    rows = list(csv.reader(io.StringIO(content), delimiter=delimiter))
+    if not rows:
+        return content
+
+    pii_indices = [index for index, column in enumerate(rows[0]) if column in PII_CSV_COLUMNS]
+    for row in rows[1:]:
+        for index in pii_indices:
+            if index < len(row):
+                row[index] = scrub_value(row[index])
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator="\n")
+    writer.writerows(rows)
+    return buffer.getvalue()
@@ -0,0 +1,84 @@
+"""
+Micro-benchmark comparing csv.DictReader rows against the header-indexed records of shared.csv_reader.
+Generates synthetic exported orders and order confirmations, parses them with both approaches and reports parse time
+and memory retained by the parsed rows.
+
+From the root directory execute:
+    python -m scripts.benchmark_csv_records --rows 100000
+"""
+import argparse
+import csv
+import io
+import sys
+import time
+import tracemalloc
+
+from shared.const.csv_column_names import ExportedOrderCSV, OrderConfirmationCSV
+from shared.csv_reader import read_exported_orders, read_order_confirmations
+
+"""Columns which are present in the real ERP export, but ignored by the offloader"""
+EXTRA_EXPORT_COLUMNS = ["Belegdatum", "Lieferadresse_Anrede", "Lieferadresse_Zusatz", "Kundennummer", "Bemerkung"]
+
+
+def _generate_exported_orders(rows):
+    header = list(dict.fromkeys([
+        ExportedOrderCSV.ORDER_ID, ExportedOrderCSV.FIRST_NAME, ExportedOrderCSV.LAST_NAME,
+        ExportedOrderCSV.ADDRESS_STREET, ExportedOrderCSV.ADDRESS_HOUSE, ExportedOrderCSV.COMPANY,
+        ExportedOrderCSV.ZIP, ExportedOrderCSV.CITY, ExportedOrderCSV.COUNTRY, ExportedOrderCSV.EAN,
+        ExportedOrderCSV.QUANTITY, ExportedOrderCSV.PRICE, ExportedOrderCSV.POSITION_NUM
+    ])) + EXTRA_EXPORT_COLUMNS
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";", lineterminator="\n")
+    writer.writerow(header)
+    for i in range(rows):
+        writer.writerow([f"PO{i}", "Max", "Mustermann", "Musterstrasse", str(i % 200), "Muster GmbH", "12345",
+                         "Musterstadt", "DE", f"{4000000000000 + i}", "1", "19.99", "1",
+                         "20200101", "Herr", "", f"K{i}", ""])
+    return buffer.getvalue()
+
+
+def _generate_order_confirmations(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";", quoting=csv.QUOTE_ALL, lineterminator="\n")
+    writer.writerow(OrderConfirmationCSV.FIELDNAMES)
+    for i in range(rows):
+        writer.writerow([str(1000000 + i), "1", "1", "confirmed", "", "", "", ""])
+    return buffer.getvalue()
+
+
+def _parse_with_dict_reader(content):
+    # Mirrors the previous checker behaviour, which copied the whole row dictionary for each order
+    return [dict(row) for row in csv.DictReader(io.StringIO(content), delimiter=";")]
+
+
+def _measure(name, parse, content):
+    start = time.perf_counter()
+    parse(content)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    rows = parse(content)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<32} {elapsed * 1000:>10.1f} ms {retained / 1024 / 1024:>10.1f} MiB ({len(rows)} rows)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks CSV parsing into dictionaries against records")
+    parser.add_argument("-r", "--rows", type=int, default=100000, help="number of rows to generate")
+    args = parser.parse_args()
+
+    exported_orders = _generate_exported_orders(args.rows)
+    confirmations = _generate_order_confirmations(args.rows)
+
+    print(f"{'':<32} {'parse time':>13} {'retained':>14}")
+    _measure("exported orders, DictReader", _parse_with_dict_reader, exported_orders)
+    _measure("exported orders, records", lambda c: list(read_exported_orders(io.StringIO(c))), exported_orders)
+    _measure("confirmations, DictReader", _parse_with_dict_reader, confirmations)
+    _measure("confirmations, records", lambda c: list(read_order_confirmations(io.StringIO(c))), confirmations)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Benchmark comparing decoding of the whole variant catalog as a single response against the page by page decoding into
+the compact variant index used by LightspeedClient.get_variant_index. Every mode runs in a separate process, so peak
+RSS of the modes doesn't affect each other.
+
+From the root directory execute:
+    python -m scripts.benchmark_variant_decoding --variants 50000
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from shared import fast_json
+from shared.variant_index import extract_variant_index_page
+
+"""Page size used by LightspeedClient.get_variant_index"""
+PAGE_LIMIT = 250
+
+"""Benchmarked modes"""
+MODES = ["whole-catalog", "paged-index"]
+
+
+def _generate_variant(variant_id):
+    # Shape of the variant resource returned by Lightspeed, see
+    # https://developers.lightspeedhq.com/ecom/endpoints/variant/#get-all-variants
+    return {
+        "id": variant_id,
+        "createdAt": "2020-01-01T10:00:00+01:00",
+        "updatedAt": "2020-01-02T10:00:00+01:00",
+        "isDefault": True,
+        "sortOrder": 1,
+        "articleCode": f"ART-{variant_id}",
+        "ean": f"{4000000000000 + variant_id}",
+        "sku": f"SKU-{variant_id}",
+        "hs": None,
+        "tax": 21,
+        "priceExcl": 16.5,
+        "priceIncl": 19.97,
+        "priceCost": 10,
+        "oldPriceExcl": 0,
+        "oldPriceIncl": 0,
+        "stockTracking": "enabled",
+        "stockLevel": 12,
+        "stockAlert": 0,
+        "stockMinimum": 0,
+        "stockSold": 3,
+        "stockBuyMinimum": 1,
+        "stockBuyMaximum": 10000,
+        "weight": 1000,
+        "weightValue": 1,
+        "weightUnit": "kg",
+        "volume": 0,
+        "colli": 1,
+        "sizeX": 0,
+        "sizeY": 0,
+        "sizeZ": 0,
+        "title": f"Variant {variant_id} - some longer descriptive title",
+        "image": {"src": f"https://cdn.example.com/images/{variant_id}/image.jpg", "thumb": "thumb.jpg"},
+        "tax_schedule": {"resource": {"id": 1, "url": "taxes/1", "link": "https://api.webshopapp.com/taxes/1.json"}},
+        "product": {"resource": {"id": variant_id, "url": f"products/{variant_id}",
+                                 "link": f"https://api.webshopapp.com/products/{variant_id}.json"}},
+        "movements": {"resource": {"id": False, "url": "variants/movements",
+                                   "link": "https://api.webshopapp.com/variants/movements.json"}}
+    }
+
+
+def _run_mode(mode, variants):
+    if mode == "whole-catalog":
+        payloads = [json.dumps({"variants": [_generate_variant(i) for i in range(variants)]}).encode("utf-8")]
+    else:
+        payloads = [
+            json.dumps({"variants": [_generate_variant(i) for i in range(start, min(start + PAGE_LIMIT, variants))]})
+            .encode("utf-8")
+            for start in range(0, variants, PAGE_LIMIT)
+        ]
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    if mode == "whole-catalog":
+        # Previous behaviour: response.json() of the whole catalog, kept as a list of full variant dictionaries
+        catalog = json.loads(payloads[0])["variants"]
+        lookups = len(catalog)
+    else:
+        variant_index = {}
+        for payload in payloads:
+            for ean, variant_id, _ in extract_variant_index_page(fast_json.loads(payload))["entries"]:
+                variant_index.setdefault(ean, variant_id)
+        lookups = len(variant_index)
+    elapsed = time.perf_counter() - start
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"mode": mode, "seconds": elapsed, "rss_kib": peak_rss - baseline_rss, "variants": lookups}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks decoding of the Lightspeed variant catalog")
+    parser.add_argument("-n", "--variants", type=int, default=50000, help="number of variants to generate")
+    parser.add_argument("--mode", choices=MODES, help="run a single mode in the current process")
+    args = parser.parse_args()
+
+    if args.mode:
+        _run_mode(args.mode, args.variants)
+        return 0
+
+    print(f"JSON backend: {fast_json.BACKEND}")
+    print(f"{'':<16} {'decode time':>14} {'peak RSS growth':>17}")
+    for mode in MODES:
+        output = subprocess.check_output([sys.executable, "-m", "scripts.benchmark_variant_decoding",
+                                          "--variants", str(args.variants), "--mode", mode])
+        result = json.loads(output)
+        print(f"{mode:<16} {result['seconds'] * 1000:>11.1f} ms {result['rss_kib'] / 1024:>13.1f} MiB")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -37,8 +37,8 @@ fi
 PY_PATH=`which python3`
 CRONTAB_FILE=crontab.tmp
 echo "Creating crontab..."
-echo "0 8,10,12,14,16,18,20 * * * cd $1 && $PY_PATH -m lightspeed_offloader -c config/application.yaml -l config/logging.yaml >> logs/stacktrace.log 2>&1" >> ${CRONTAB_FILE}
-echo "5 8,10,12,14,16,18,20 * * * cd $1 && $PY_PATH -m status_checker -c config/application.yaml -l config/logging.yaml >> logs/stacktrace.log 2>&1" >> ${CRONTAB_FILE}
+echo "0 8,10,12,14,16,18,20 * * * cd $1 && $PY_PATH -m lightspeed_offloader -c config/application.yaml -l config/logging.yaml --max-runtime 110 >> logs/stacktrace.log 2>&1" >> ${CRONTAB_FILE}
+echo "5 8,10,12,14,16,18,20 * * * cd $1 && $PY_PATH -m status_checker -c config/application.yaml -l config/logging.yaml --max-runtime 110 >> logs/stacktrace.log 2>&1" >> ${CRONTAB_FILE}
 crontab ${CRONTAB_FILE}
 if [ $? -ne 0 ]
 then
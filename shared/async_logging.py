@@ -0,0 +1,141 @@
+"""
+This module contains a non-blocking logging pipeline. If the log config contains 'queue: true', handlers configured
+for the root logger are moved behind a QueueHandler, and a QueueListener thread performs all the formatting and file
+I/O, so the threads creating orders never wait for a file lock.
+
+Records are enriched with the context of the current thread, i.e. 'order_id', 'checkout_id' and 'phase', which can be
+used by any formatter, e.g. '%(order_id)s', and are emitted as separate fields by JsonFormatter.
+"""
+import atexit
+import json
+import logging
+import logging.config
+import logging.handlers
+import queue
+import threading
+from contextlib import contextmanager
+
+"""Context fields added to every log record, None if not set"""
+CONTEXT_FIELDS = ("order_id", "checkout_id", "phase")
+
+_context = threading.local()
+_listener = None
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Adds the fields into the context of every record logged by the current thread within the block.
+    :param fields: context fields, e.g. order_id
+    """
+    previous = getattr(_context, "fields", None)
+    _context.fields = dict(previous, **fields) if previous else fields
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+def update_log_context(**fields):
+    """
+    Adds the fields into the innermost context of the current thread, e.g. checkout id as soon as it is known.
+    :param fields: context fields
+    """
+    current = getattr(_context, "fields", None)
+    if current is not None:
+        current.update(fields)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the context of the logging thread into the record. It must run in the logging thread, i.e. it is attached
+    to the QueueHandler in queue mode, and to the root handlers otherwise.
+    """
+
+    def filter(self, record):
+        fields = getattr(_context, "fields", None) or {}
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, fields.get(field))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as single-line JSON objects with the context fields.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Merge the arguments now, since they may be changed by the caller before the listener formats the record,
+        # but leave the formatting of the final line to the listener
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(log_config: dict):
+    """
+    Configures logging from the dictionary config. If the config contains 'queue: true', the root handlers are
+    served by a background QueueListener, which is stopped at interpreter exit.
+    :param log_config: (dict) logging config in logging.config.dictConfig format with an optional 'queue' key
+    """
+    global _listener
+
+    log_config = dict(log_config)
+    use_queue = log_config.pop("queue", False)
+    logging.config.dictConfig(log_config)
+
+    root = logging.getLogger()
+    if not use_queue:
+        for handler in root.handlers:
+            handler.addFilter(ContextFilter())
+        return
+
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    records = queue.Queue(-1)
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """
+    Stops the QueueListener, and flushes the records logged so far.
+    """
+    global _listener
+
+    if _listener:
+        listener, _listener = _listener, None
+        listener.stop()
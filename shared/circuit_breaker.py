@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+from .exceptions import CircuitOpenException
+
+"""Calls pass through, failures are counted"""
+STATE_CLOSED = "closed"
+"""Calls are rejected without being sent"""
+STATE_OPEN = "open"
+"""A single probe call is let through to find out if the service is available again"""
+STATE_HALF_OPEN = "half-open"
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a service, which is unavailable. The circuit opens after a number of consecutive
+    failures, and every call is rejected with CircuitOpenException. Once reset_timeout passes, the circuit becomes
+    half-open and lets a single probe call through, which either closes the circuit, or opens it again.
+
+    :param failure_threshold: (number) number of consecutive failures opening the circuit
+    :param reset_timeout: (number) number of seconds the circuit stays open before a probe call is let through
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Checks if a call may be sent, or throws CircuitOpenException.
+        """
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return
+
+            if self.state == STATE_OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                self.state = STATE_HALF_OPEN
+                self._probe_in_flight = False
+
+            if self.state == STATE_HALF_OPEN and not self._probe_in_flight:
+                log.info("Sending a probe request to find out, if the service is available again")
+                self._probe_in_flight = True
+                return
+
+        raise CircuitOpenException(f"Circuit is open after {self._failures} consecutive failures")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != STATE_CLOSED:
+                log.info("Service is available again, closing the circuit")
+            self.state = STATE_CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == STATE_HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != STATE_OPEN:
+                    log.error(f"Opening the circuit after {self._failures} consecutive failures")
+                self.state = STATE_OPEN
+                self._opened_at = time.time()
+                self._probe_in_flight = False
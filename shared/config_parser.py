@@ -1,4 +1,5 @@
 import logging
+import os
 import yaml
 from .password_encryption import decrypt
 
@@ -39,16 +40,19 @@ class ConfigParser:
         sftp_input_dir = self.config["sftp-input-folder"]
         sftp_output_dir = self.config["sftp-output-folder"]
         sftp_archive_dir = self.config["sftp-archive-folder"]
+        sftp_channels = self.config.get("sftp-channels", 4)
+        sftp_keepalive = self.config.get("sftp-keepalive-seconds", 30)
 
         return SFTPClient(sftp_host, sftp_port, sftp_user, sftp_password, sftp_input_dir, sftp_output_dir,
-                          sftp_archive_dir)
+                          sftp_archive_dir, sftp_channels, sftp_keepalive)
 
-    def create_lightspeed_client(self):
+    def create_lightspeed_client(self, module_name=None):
         """
         Creates Lightspeed client based on the provided config
+        :param module_name: (str) name of the module using the client, each module keeps its own response cache
         :return: an instance of LightspeedClient class
         """
-        from .lightspeed_client import LightspeedClient
+        from .lightspeed_client import DEFAULT_VARIANTS_MAX_AGE, LightspeedClient
 
         lspeed_api_url = self.config["lightspeed-api-url"]
         lspeed_api_key = self.config["lightspeed-api-key"]
@@ -60,7 +64,61 @@ class ConfigParser:
             log.critical(f"Cannot read {lspeed_api_secret_file} file")
             return None
 
-        return LightspeedClient(lspeed_api_url, lspeed_api_key, lspeed_api_secret)
+        variants_max_age = self.config.get("lightspeed-variants-max-age", DEFAULT_VARIANTS_MAX_AGE)
+        response_cache = self.create_response_cache(module_name)
+
+        return LightspeedClient(lspeed_api_url, lspeed_api_key, lspeed_api_secret, response_cache, variants_max_age,
+                                circuit_breaker=self.create_circuit_breaker(), timeout=self.get_lightspeed_timeout())
+
+    def get_lightspeed_timeout(self):
+        """
+        :return: (connect, read) timeouts of Lightspeed requests in seconds based on the provided config
+        """
+        return (self.config.get("lightspeed-connect-timeout-seconds", 10),
+                self.config.get("lightspeed-read-timeout-seconds", 60))
+
+    def create_circuit_breaker(self):
+        """
+        Creates circuit breaker stopping Lightspeed requests during outages based on the provided config
+        :return: an instance of CircuitBreaker class
+        """
+        from .circuit_breaker import CircuitBreaker
+
+        failure_threshold = self.config.get("lightspeed-circuit-failures", 5)
+        reset_timeout = self.config.get("lightspeed-circuit-reset-seconds", 30)
+
+        return CircuitBreaker(failure_threshold, reset_timeout)
+
+    def create_response_cache(self, module_name=None):
+        """
+        Creates cache of read-only Lightspeed responses based on the provided config. Modules run concurrently, so
+        the module name is appended to the cache file name, e.g. './state/http-cache-status_checker.json'.
+        :param module_name: (str) name of the module using the cache, the configured path is used as is if None
+        :return: an instance of ResponseCache class
+        """
+        from .http_cache import ResponseCache
+
+        cache_path = self.config.get("http-cache-path")
+        if cache_path and module_name:
+            root, extension = os.path.splitext(cache_path)
+            cache_path = f"{root}-{module_name}{extension}"
+        cache_max_entries = self.config.get("http-cache-max-entries", 1000)
+
+        return ResponseCache(cache_max_entries, cache_path)
+
+    def create_post_finish_queue(self, lightspeed_client):
+        """
+        Creates queue of actions, which follow order creation, based on the provided config
+        :param lightspeed_client: (LightspeedClient) client used to execute the actions
+        :return: an instance of PostFinishQueue class
+        """
+        from .post_finish_queue import PostFinishQueue
+
+        state_path = self.config.get("post-finish-state-path", "./state/post-finish-actions.json")
+        workers = self.config.get("post-finish-workers", 4)
+        max_attempts = self.config.get("post-finish-max-attempts", 3)
+
+        return PostFinishQueue(lightspeed_client, state_path, workers, max_attempts)
 
     def get_config(self):
         """
@@ -0,0 +1,83 @@
+import csv
+from collections import namedtuple
+from operator import itemgetter
+
+from .const.csv_column_names import ExportedOrderCSV, OrderConfirmationCSV
+from .exceptions import CSVFormatException
+
+"""Delimiter used by both exported orders and order confirmation CSV files"""
+CSV_DELIMITER = ";"
+
+"""A single row of the exported orders CSV file"""
+ExportedOrder = namedtuple("ExportedOrder", ["order_id", "first_name", "last_name", "email", "address_street",
+                                             "address_house", "company", "zip", "city", "country", "ean",
+                                             "quantity", "price", "position_num"])
+EXPORTED_ORDER_COLUMNS = (ExportedOrderCSV.ORDER_ID, ExportedOrderCSV.FIRST_NAME, ExportedOrderCSV.LAST_NAME,
+                          ExportedOrderCSV.EMAIL, ExportedOrderCSV.ADDRESS_STREET, ExportedOrderCSV.ADDRESS_HOUSE,
+                          ExportedOrderCSV.COMPANY, ExportedOrderCSV.ZIP, ExportedOrderCSV.CITY,
+                          ExportedOrderCSV.COUNTRY, ExportedOrderCSV.EAN, ExportedOrderCSV.QUANTITY,
+                          ExportedOrderCSV.PRICE, ExportedOrderCSV.POSITION_NUM)
+
+"""A single row of the order confirmation CSV file. Fields follow OrderConfirmationCSV.FIELDNAMES order, so the
+record can be written by csv_writer as is"""
+OrderConfirmation = namedtuple("OrderConfirmation", ["order_id", "position_num", "quantity", "status",
+                                                     "tracking_number", "shipment_carrier", "tracking_link",
+                                                     "estimated_shipment_date"])
+# Python 3.6 compatible way to make every field optional
+OrderConfirmation.__new__.__defaults__ = (None,) * len(OrderConfirmation._fields)
+ORDER_CONFIRMATION_COLUMNS = tuple(OrderConfirmationCSV.FIELDNAMES)
+
+
+def read_records(file, record_type, columns):
+    """
+    Parses CSV file into a sequence of records. The header is mapped to the column indices only once, every row is
+    materialized as an instance of record_type instead of a dictionary keyed by column names.
+    :param file: file-like object or an iterable of CSV lines
+    :param record_type: (namedtuple) type of the record to create, field order must match columns
+    :param columns: (tuple) CSV column names to extract
+    :return: generator of records, or throws CSVFormatException if the header lacks some of the columns
+    """
+    reader = csv.reader(file, delimiter=CSV_DELIMITER)
+
+    header = next(reader, None)
+    if header is None:
+        return
+
+    header_indices = {}
+    for index, column in enumerate(header):
+        header_indices.setdefault(column, index)
+
+    missing_columns = [column for column in columns if column not in header_indices]
+    if missing_columns:
+        raise CSVFormatException(f"CSV header lacks columns {missing_columns}")
+
+    indices = [header_indices[column] for column in columns]
+    get_fields = itemgetter(*indices)
+    row_length = len(header)
+    make_record = record_type._make
+
+    for row in reader:
+        # Skip empty lines the same way csv.DictReader does
+        if not row:
+            continue
+        if len(row) < row_length:
+            row += [None] * (row_length - len(row))
+        yield make_record(get_fields(row))
+
+
+def read_exported_orders(file):
+    """
+    Parses exported orders CSV file.
+    :param file: file-like object containing exported orders
+    :return: generator of ExportedOrder records
+    """
+    return read_records(file, ExportedOrder, EXPORTED_ORDER_COLUMNS)
+
+
+def read_order_confirmations(file):
+    """
+    Parses order confirmation CSV file.
+    :param file: file-like object containing order confirmations
+    :return: generator of OrderConfirmation records
+    """
+    return read_records(file, OrderConfirmation, ORDER_CONFIRMATION_COLUMNS)
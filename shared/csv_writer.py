@@ -11,30 +11,25 @@ CSV_DIALECT_NAME = "dial"
 csv.register_dialect(CSV_DIALECT_NAME, delimiter=";", quoting=csv.QUOTE_ALL, lineterminator="\n")
 
 
-def save_orders_as_csv(folder_path: str, orders, fieldnames, timestamp_offset: int = 1):
+def serialize_orders_as_csv(orders, fieldnames, timestamp_offset: int = 1):
     """
-    Serializes processed orders into CSV file.
-    Note, that the method caller is responsible to create folder for a provided folder path.
-    :param folder_path: (str) an absolute path to the folder to store the output CSV file.
-    :param orders: (arr) an array of orders represented as dictionary to serialize
+    Serializes processed orders into CSV content in memory, no local file is created.
+    :param orders: (arr) an array of order records (e.g. OrderConfirmation), which fields follow the fieldnames order
     :param fieldnames: (arr) an array of CSV headers
     :param timestamp_offset: (number) number of minutes to add to the timestamp, which is used in file name
-    :return: an absolute path to the created CSV file
+    :return: (file_name, content) tuple, where content is UTF-8 encoded CSV file
     """
 
-    import os
+    import io
     from datetime import datetime, timedelta
 
     timestamp = datetime.now() + timedelta(minutes=timestamp_offset)
     file_name = f"S-{timestamp.strftime(FILE_TIMESTAMP_PATTERN)}.csv"
-    file_path = os.path.join(folder_path, file_name)
 
-    log.debug(f"Creating file {file_path} with processed orders")
-    with open(file_path, "w") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect=CSV_DIALECT_NAME)
-        writer.writeheader()
-        writer.writerows(orders)
+    log.debug(f"Serializing processed orders as {file_name}")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect=CSV_DIALECT_NAME)
+    writer.writerow(fieldnames)
+    writer.writerows(orders)
 
-        csvfile.close()
-
-    return file_path
+    return file_name, buffer.getvalue().encode("utf-8")
@@ -2,5 +2,21 @@ class ProcessOrderException(Exception):
     pass
 
 
+class OutOfStockException(ProcessOrderException):
+    pass
+
+
 class UnexpectedHTTPStatusCodeException(Exception):
     pass
+
+
+class CSVFormatException(Exception):
+    pass
+
+
+class LightspeedUnavailableException(UnexpectedHTTPStatusCodeException):
+    pass
+
+
+class CircuitOpenException(Exception):
+    pass
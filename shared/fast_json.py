@@ -0,0 +1,20 @@
+"""
+This module picks the fastest available JSON decoder. orjson and ujson are optional dependencies, the standard json
+module is used if neither of them is installed.
+"""
+try:
+    import orjson
+
+    BACKEND = "orjson"
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        BACKEND = "ujson"
+        loads = ujson.loads
+    except ImportError:
+        import json
+
+        BACKEND = "json"
+        loads = json.loads
@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .state_store import load_state, save_state
+
+log = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Bounded LRU store of decoded HTTP response bodies together with their ETag/Last-Modified validators.
+    If the path is provided, the store is loaded from and saved into a local JSON file, so it survives between runs.
+
+    :param max_entries: (number) maximum number of stored responses, least recently used ones are evicted first
+    :param path: (str) optional path to the JSON file to persist the store into
+    """
+
+    def __init__(self, max_entries=1000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        if path:
+            for key, entry in load_state(path, default=[]):
+                self._entries[key] = entry
+            self._evict()
+
+    def get(self, key):
+        """
+        Returns cached entry for the key, and marks it as recently used.
+        :param key: (str) cache key, usually the request URL with query parameters
+        :return: dictionary with 'value', 'etag', 'last_modified' and 'fetched_at' attributes, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value, etag=None, last_modified=None):
+        """
+        Stores decoded response body. Value must be JSON serializable if the cache is persisted.
+        :param key: (str) cache key
+        :param value: decoded response body
+        :param etag: (str) value of the ETag response header
+        :param last_modified: (str) value of the Last-Modified response header
+        """
+        entry = {"value": value, "etag": etag, "last_modified": last_modified, "fetched_at": time.time()}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def refresh(self, key):
+        """
+        Marks cached entry as just fetched, e.g. after server has responded with 304 Not Modified.
+        :param key: (str) cache key
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["fetched_at"] = time.time()
+                self._entries.move_to_end(key)
+
+    def save(self):
+        """
+        Saves the store into the JSON file, if the path has been provided.
+        """
+        if not self.path:
+            return
+
+        with self._lock:
+            entries = list(self._entries.items())
+
+        log.debug(f"Saving {len(entries)} cached responses into {self.path}")
+        save_state(self.path, entries)
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -1,7 +1,14 @@
 import logging
+import threading
+import time
 import requests
 from base64 import b64encode
-from .exceptions import UnexpectedHTTPStatusCodeException
+from urllib.parse import urlencode
+from . import fast_json
+from .circuit_breaker import CircuitBreaker
+from .exceptions import LightspeedUnavailableException, UnexpectedHTTPStatusCodeException
+from .tracing import traced_phase
+from .variant_index import extract_variant_index_page, get_available_stock
 
 CHECKOUT_ENDPOINT = "/checkouts.json"
 VARIANT_ENDPOINT = "/variants.json"
@@ -9,20 +16,60 @@ PRODUCT_ENDPOINT = "/products.json"
 VALIDATE_ENDPOINT = "/validate.json"
 ORDER_ENDPOINT = "/order.json"
 SHIPMENT_ENDPOINT = "/shipments.json"
+RETURN_ENDPOINT = "/returns.json"
+ORDERS_ENDPOINT = "/orders.json"
+
+"""Maximum page size supported by Lightspeed API"""
+PAGE_LIMIT = 250
+"""Number of seconds the variant catalog, including the stock levels, is reused without any request by default"""
+DEFAULT_VARIANTS_MAX_AGE = 300
 
 
 # In case of performance issues see https://2.python-requests.org/en/master/user/advanced/#session-objects
 class LightspeedClient:
-    def __init__(self, api_url, api_key, api_secret):
+    """
+    Client of the Lightspeed eCom REST API.
+
+    :param api_url: (str) base URL of the Lightspeed shop
+    :param api_key: (str) Lightspeed API key
+    :param api_secret: (str) Lightspeed API secret
+    :param response_cache: (ResponseCache) optional cache of read-only responses used for conditional GET requests
+    :param variants_max_age: (number) number of seconds the cached variant catalog is used without any request,
+    defaults to DEFAULT_VARIANTS_MAX_AGE, 0 fetches it for every row
+    :param http: object providing get, post, put and delete functions with the requests module interface, e.g.
+    a recorder used by the replay harness, defaults to the requests module
+    :param circuit_breaker: (CircuitBreaker) stops sending requests during Lightspeed outages, defaults to a circuit
+    opening after 5 consecutive failures
+    :param timeout: (tuple) (connect, read) timeouts of every request in seconds, a stalled request fails as
+    a connection error
+    """
+
+    def __init__(self, api_url, api_key, api_secret, response_cache=None, variants_max_age=DEFAULT_VARIANTS_MAX_AGE,
+                 http=None, circuit_breaker=None, timeout=(10, 60)):
         self.log = logging.getLogger(__name__)
         self.api_url = api_url
         self.api_key = api_key
         self.api_secret = api_secret
+        self.response_cache = response_cache
+        self.variants_max_age = variants_max_age
+        self.http = http or requests
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.timeout = timeout
+        self.rate_limit = None
+        self.call_count = 0
+        self.call_seconds = 0
+        self._stats_lock = threading.Lock()
+        self._variant_index = None
+        self._variant_stock = {}
+        self._variant_index_fetched_at = 0
+        # Checkouts created, but not converted into orders, e.g. since validation has failed
+        self.unfinished_checkouts = set()
 
     def _get_auth_header(self):
         b64_credentials = b64encode(bytes(self.api_key + ":" + self.api_secret, "utf-8")).decode("ascii")
         return "Basic " + b64_credentials
 
+    @traced_phase("create_checkout")
     def create_checkout(self, checkout):
         """
         Sends HTTP POST request to Lightspeed API to create new checkout.
@@ -34,30 +81,113 @@ class LightspeedClient:
 
         headers = {"Authorization": self._get_auth_header()}
         req_url = self.api_url + CHECKOUT_ENDPOINT
-        response = requests.post(req_url, headers=headers, json=checkout)
+        response = self._send("POST", req_url, headers=headers, json=checkout)
 
         self._validate_response_status_code(response, 201, req_url, "POST")
 
         response_body = response.json()
+        self.unfinished_checkouts.add(response_body["id"])
         return response_body["id"]
 
-    def get_all_product_variants(self):
+    @traced_phase("create_checkout_with_details")
+    def create_checkout_with_details(self, checkout):
+        """
+        Sends HTTP POST request to Lightspeed API to create new checkout, which may already contain products,
+        shipment and payment methods.
+        See https://developers.lightspeedhq.com/ecom/endpoints/checkout/#post-create-a-new-checkout
+        :param checkout: (dict) HTTP POST body represented as dictionary for an easy JSON serialization
+        :return: complete checkout object returned by Lightspeed, or throws UnexpectedHTTPStatusCodeException in case
+        of HTTP error
         """
-        Fetches all product variants.
+        self.log.debug("Creating checkout with details for %s", checkout["customer"]["email"])
+
+        headers = {"Authorization": self._get_auth_header()}
+        req_url = self.api_url + CHECKOUT_ENDPOINT
+        response = self._send("POST", req_url, headers=headers, json=checkout)
+
+        self._validate_response_status_code(response, 201, req_url, "POST")
+
+        response_body = response.json()
+        self.unfinished_checkouts.add(response_body["id"])
+        return response_body
+
+    @traced_phase("get_variant_index")
+    def get_variant_index(self):
+        """
+        Fetches all product variants page by page, and keeps only the fields needed to create orders, i.e. ids and
+        available stock. Only a single page of decoded variants is held in memory at a time. The index is reused for
+        variants_max_age seconds.
         See https://developers.lightspeedhq.com/ecom/endpoints/variant/#get-all-variants
-        :return: an array of product variants, or throws ProcessOrderException in case of HTTP error
+        :return: dictionary mapping variant EAN to variant id, or throws UnexpectedHTTPStatusCodeException in case of
+        HTTP error
         """
+        if self._variant_index is not None and time.time() - self._variant_index_fetched_at < self.variants_max_age:
+            return self._variant_index
+
         self.log.debug("Fetching all product variants")
 
-        headers = {"Authorization": self._get_auth_header()}
         req_url = self.api_url + VARIANT_ENDPOINT
-        response = requests.get(req_url, headers=headers)
+        variant_index = {}
+        variant_stock = {}
+        page = 1
+        while True:
+            params = {"page": page, "limit": PAGE_LIMIT, "fields": "id,ean,stockTracking,stockLevel"}
+            index_page = self._get_cached(req_url, extract_variant_index_page, params=params,
+                                          max_age=self.variants_max_age)
+            for ean, variant_id, stock in index_page["entries"]:
+                # The first variant wins in case of duplicated EAN
+                variant_index.setdefault(ean, variant_id)
+                variant_stock[variant_id] = stock
+
+            if index_page["count"] < PAGE_LIMIT:
+                break
+            page += 1
+
+        self.log.debug("Fetched %s product variants from %s pages", len(variant_index), page)
+        self._variant_index = variant_index
+        self._variant_stock = variant_stock
+        self._variant_index_fetched_at = time.time()
+        return variant_index
+
+    def get_variant_stock(self, variant_id):
+        """
+        Returns available stock of the variant from the variant index, which is refreshed once it gets older than
+        variants_max_age seconds.
+        :param variant_id: (number) id of the variant
+        :return: number of items, which can be ordered, or None if the stock is not tracked
+        """
+        self.get_variant_index()
+        return self._variant_stock.get(variant_id)
 
-        self._validate_response_status_code(response, 200, req_url, "GET")
+    @traced_phase("refresh_variant_stock")
+    def refresh_variant_stock(self, variant_id):
+        """
+        Fetches the current stock of a single variant, and replaces the stock kept in the variant index, which may be
+        outdated, e.g. to confirm a shortage before the row is rejected.
+        See https://developers.lightspeedhq.com/ecom/endpoints/variant/#get-retrieve-a-variant
+        :param variant_id: (number) id of the variant
+        :return: number of items, which can be ordered, or None if the stock is not tracked, or throws
+        UnexpectedHTTPStatusCodeException in case of HTTP error
+        """
+        self.log.debug("Fetching stock of variant %s", variant_id)
 
-        response_body = response.json()
-        return response_body["variants"]
+        req_url = f"{self.api_url}/variants/{variant_id}.json"
+        stock = self._get_cached(req_url, lambda response_body: get_available_stock(response_body["variant"]))
+        self._variant_stock[variant_id] = stock
+        return stock
+
+    def reserve_variant_stock(self, variant_id, quantity):
+        """
+        Subtracts ordered items from the stock of the variant, so the orders created before the index is refreshed
+        are taken into account.
+        :param variant_id: (number) id of the variant
+        :param quantity: (number) number of ordered items
+        """
+        stock = self._variant_stock.get(variant_id)
+        if stock is not None:
+            self._variant_stock[variant_id] = max(stock - quantity, 0)
 
+    @traced_phase("add_product_to_checkout")
     def add_product_to_checkout(self, product, checkout_id):
         """
         Adds product to the checkout.
@@ -66,20 +196,18 @@ class LightspeedClient:
         :param checkout_id: (number) an id of the checkout to add product in
         :return: product id generated by Lightspeed, or throws ProcessOrderException in case of HTTP error
         """
-        self.log.debug(
-            (f"Adding product to the checkout {checkout_id}\n"
-             f"Product: {product}")
-        )
+        self.log.debug("Adding product to the checkout %s\nProduct: %s", checkout_id, product)
 
         headers = {"Authorization": self._get_auth_header()}
         req_url = f"{self.api_url}/checkouts/{checkout_id}{PRODUCT_ENDPOINT}"
-        response = requests.post(req_url, headers=headers, json=product)
+        response = self._send("POST", req_url, headers=headers, json=product)
 
         self._validate_response_status_code(response, 201, req_url, "POST")
 
         response_body = response.json()
         return response_body["id"]
 
+    @traced_phase("add_shipment_and_payment_methods")
     def add_shipment_and_payment_methods(self, methods_information, checkout_id):
         """
         Updates checkout by adding 'shipment_method' and 'payment_method' fields.
@@ -92,13 +220,14 @@ class LightspeedClient:
 
         headers = {"Authorization": self._get_auth_header()}
         req_url = f"{self.api_url}/checkouts/{checkout_id}.json"
-        response = requests.put(req_url, headers=headers, json=methods_information)
+        response = self._send("PUT", req_url, headers=headers, json=methods_information)
 
         self._validate_response_status_code(response, 200, req_url, "PUT")
 
         response_body = response.json()
         return response_body
 
+    @traced_phase("validate_checkout")
     def validate_checkout(self, checkout_id):
         """
         Validate checkout before creating it.
@@ -111,13 +240,14 @@ class LightspeedClient:
 
         headers = {"Authorization": self._get_auth_header()}
         req_url = f"{self.api_url}/checkouts/{checkout_id}{VALIDATE_ENDPOINT}"
-        response = requests.get(req_url, headers=headers)
+        response = self._send("GET", req_url, headers=headers)
 
         self._validate_response_status_code(response, 200, req_url, "GET")
 
         response_body = response.json()
         return response_body
 
+    @traced_phase("finish_checkout")
     def finish_checkout(self, checkout_id):
         """
        Converts checkout into an order.
@@ -130,13 +260,55 @@ class LightspeedClient:
         headers = {"Authorization": self._get_auth_header()}
         req_url = f"{self.api_url}/checkouts/{checkout_id}{ORDER_ENDPOINT}"
         # Non-empty payload is required by Lightspeed
-        response = requests.post(req_url, headers=headers, json={"comment": ""})
+        response = self._send("POST", req_url, headers=headers, json={"comment": ""})
 
         self._validate_response_status_code(response, 200, req_url, "POST")
 
         response_body = response.json()
+        self.unfinished_checkouts.discard(checkout_id)
         return response_body["order_id"]
 
+    @traced_phase("finish_checkout_with_details")
+    def finish_checkout_with_details(self, checkout_id, finish_information):
+        """
+        Converts checkout into an order, passing additional order information, e.g. payment status.
+        See https://developers.lightspeedhq.com/ecom/tutorials/creating-an-order/#post-finish-the-checkout.
+        :param checkout_id: (number) an id of the checkout to submit
+        :param finish_information: (dict) HTTP POST body represented as dictionary for an easy JSON serialization
+        :return: complete response body containing 'order_id', or throws UnexpectedHTTPStatusCodeException in case
+        of HTTP error
+        """
+        self.log.debug("Creating order with details from checkout %s", checkout_id)
+
+        headers = {"Authorization": self._get_auth_header()}
+        req_url = f"{self.api_url}/checkouts/{checkout_id}{ORDER_ENDPOINT}"
+        response = self._send("POST", req_url, headers=headers, json=finish_information)
+
+        self._validate_response_status_code(response, 200, req_url, "POST")
+
+        self.unfinished_checkouts.discard(checkout_id)
+        return response.json()
+
+    @traced_phase("delete_checkout")
+    def delete_checkout(self, checkout_id):
+        """
+        Deletes checkout, which has never been converted into an order.
+        See https://developers.lightspeedhq.com/ecom/endpoints/checkout/#delete-delete-a-checkout
+        :param checkout_id: (number) an id of the checkout to delete
+        :return: None, or throws UnexpectedHTTPStatusCodeException in case of HTTP error, a missing checkout is
+        considered deleted
+        """
+        self.log.debug("Deleting checkout %s", checkout_id)
+
+        headers = {"Authorization": self._get_auth_header()}
+        req_url = f"{self.api_url}/checkouts/{checkout_id}.json"
+        response = self._send("DELETE", req_url, headers=headers)
+
+        if response.status_code in (200, 204, 404):
+            return
+        self._validate_response_status_code(response, 204, req_url, "DELETE")
+
+    @traced_phase("update_order_payment_status")
     def update_order_payment_status(self, order_id, payment_status):
         """
         Updates an order with a given payment status.
@@ -145,18 +317,19 @@ class LightspeedClient:
         :param payment_status: (dict) payment status to set
         :return: complete order object returned by Lightspeed
         """
-        self.log.debug(f"Setting order {order_id} as paid")
+        self.log.debug("Setting order %s as paid", order_id)
 
         headers = {"Authorization": self._get_auth_header()}
         req_url = f"{self.api_url}/orders/{order_id}.json"
 
-        response = requests.put(req_url, headers=headers, json=payment_status)
+        response = self._send("PUT", req_url, headers=headers, json=payment_status)
 
         self._validate_response_status_code(response, 200, req_url, "PUT")
 
         response_body = response.json()
         return response_body["order"]
 
+    @traced_phase("get_order_status")
     def get_order_status(self, order_id: str):
         """
         Retrieves order status based on provided id.
@@ -164,36 +337,188 @@ class LightspeedClient:
         :param order_id: order id
         :return: order status string
         """
-        self.log.debug(f"Retrieving order status for order {order_id}")
+        self.log.debug("Retrieving order status for order %s", order_id)
 
-        headers = {"Authorization": self._get_auth_header()}
         req_url = f"{self.api_url}/orders/{order_id}.json"
+        return self._get_cached(req_url, lambda response_body: response_body["order"]["status"])
 
-        response = requests.get(req_url, headers=headers)
-
-        self._validate_response_status_code(response, 200, req_url, "GET")
-
-        response_body = response.json()
-        return response_body["order"]["status"]
-
+    @traced_phase("get_shipment_for_order")
     def get_shipment_for_order(self, order_id: str):
         """
         Retrieves shipment object for provided order id
         :param order_id: order id to fetch shipment information for
         :return: an array of shipment objects
         """
-        self.log.debug(f"Retrieving shipment tracking number for order {order_id}")
+        self.log.debug("Retrieving shipment tracking number for order %s", order_id)
 
-        headers = {"Authorization": self._get_auth_header()}
         params = {"order": order_id}
         req_url = f"{self.api_url}{SHIPMENT_ENDPOINT}"
+        return self._get_cached(req_url, lambda response_body: response_body["shipments"], params=params)
 
-        response = requests.get(req_url, headers=headers, params=params)
+    @traced_phase("get_orders_created_between")
+    def get_orders_created_between(self, created_at_min: str, created_at_max: str):
+        """
+        Retrieves all orders created within the given time range, page by page, with the fields needed to reconcile
+        them with the order confirmations.
+        See https://developers.lightspeedhq.com/ecom/endpoints/order/#get-retrieve-all-orders
+        :param created_at_min: (str) time in 'YYYY-MM-DD HH:MM:SS' format
+        :param created_at_max: (str) time in 'YYYY-MM-DD HH:MM:SS' format
+        :return: an array of order objects with 'id', 'createdAt', 'status', 'paymentStatus' and 'email' fields
+        """
+        self.log.debug("Retrieving orders created between %s and %s", created_at_min, created_at_max)
+
+        headers = {"Authorization": self._get_auth_header()}
+        req_url = self.api_url + ORDERS_ENDPOINT
+        orders = []
+        page = 1
+        while True:
+            params = {"page": page, "limit": PAGE_LIMIT, "created_at_min": created_at_min,
+                      "created_at_max": created_at_max, "fields": "id,createdAt,status,paymentStatus,email"}
+            response = self._send("GET", req_url, headers=headers, params=params)
+
+            self._validate_response_status_code(response, 200, req_url, "GET")
+
+            page_orders = fast_json.loads(response.content)["orders"]
+            orders.extend(page_orders)
+            if len(page_orders) < PAGE_LIMIT:
+                break
+            page += 1
+
+        return orders
+
+    @traced_phase("get_returns_updated_since")
+    def get_returns_updated_since(self, updated_at_min: str):
+        """
+        Retrieves all returns, which have been created or updated since the given time, page by page.
+        See https://developers.lightspeedhq.com/ecom/endpoints/return/#get-retrieve-all-returns
+        :param updated_at_min: (str) time in 'YYYY-MM-DD HH:MM:SS' format
+        :return: an array of return objects with 'id', 'updatedAt' and 'order' fields
+        """
+        self.log.debug("Retrieving returns updated since %s", updated_at_min)
+
+        headers = {"Authorization": self._get_auth_header()}
+        req_url = self.api_url + RETURN_ENDPOINT
+        returns = []
+        page = 1
+        while True:
+            params = {"page": page, "limit": PAGE_LIMIT, "updated_at_min": updated_at_min,
+                      "fields": "id,updatedAt,order"}
+            response = self._send("GET", req_url, headers=headers, params=params)
+
+            self._validate_response_status_code(response, 200, req_url, "GET")
+
+            page_returns = fast_json.loads(response.content)["returns"]
+            returns.extend(page_returns)
+            if len(page_returns) < PAGE_LIMIT:
+                break
+            page += 1
+
+        return returns
+
+    def get_average_call_latency(self):
+        """
+        Returns average duration of the calls sent by this client.
+        :return: number of seconds, or None if no call has been sent yet
+        """
+        with self._stats_lock:
+            return self.call_seconds / self.call_count if self.call_count else None
+
+    def get_remaining_daily_quota(self):
+        """
+        Returns the number of calls, which can still be sent today, as reported by the last Lightspeed response.
+        See https://developers.lightspeedhq.com/ecom/introduction/ratelimiting/
+        :return: number of calls, or None if Lightspeed hasn't reported it yet
+        """
+        with self._stats_lock:
+            if not self.rate_limit:
+                return None
+            return self.rate_limit["remaining"][-1]
+
+    def _send(self, method, req_url, **kwargs):
+        """
+        Sends HTTP request, and records its duration and rate limit reported by Lightspeed. Connection errors, timeouts
+        and 5xx responses are counted by the circuit breaker, and no request is sent while the circuit is open.
+        :param method: (str) HTTP method
+        :param req_url: (str) request URL
+        :param kwargs: keyword arguments of the requests module functions
+        :return: response object, or throws CircuitOpenException if the circuit is open, or
+        LightspeedUnavailableException in case of connection error or timeout
+        """
+        self.circuit_breaker.before_call()
+        kwargs.setdefault("timeout", self.timeout)
+
+        start = time.perf_counter()
+        try:
+            response = getattr(self.http, method.lower())(req_url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.circuit_breaker.record_failure()
+            raise LightspeedUnavailableException(f"HTTP {method} {req_url} has failed.\nError: {e}") from e
+        elapsed = time.perf_counter() - start
+
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+        rate_limit = _parse_rate_limit(response.headers)
+        with self._stats_lock:
+            self.call_count += 1
+            self.call_seconds += elapsed
+            if rate_limit:
+                self.rate_limit = rate_limit
+
+        return response
+
+    def save_cache(self):
+        """
+        Persists cached responses, so the next run can send conditional requests.
+        """
+        if self.response_cache:
+            self.response_cache.save()
+
+    def _get_cached(self, req_url, extract, params=None, max_age=0):
+        """
+        Sends HTTP GET request, which is served from the response cache whenever possible. Cached entry younger than
+        max_age is returned without any request, otherwise the request is sent with If-None-Match/If-Modified-Since
+        headers, and 304 Not Modified response is served from the cache.
+        :param req_url: (str) request URL
+        :param extract: (function) extracts the needed part of the decoded response body, the result is cached
+        :param params: (dict) query parameters
+        :param max_age: (number) number of seconds the cached entry is considered fresh
+        :return: extracted part of the response body, or throws UnexpectedHTTPStatusCodeException in case of HTTP error
+        """
+        headers = {"Authorization": self._get_auth_header()}
+
+        cache_key = req_url
+        if params:
+            cache_key += "?" + urlencode(sorted(params.items()))
+
+        entry = self.response_cache.get(cache_key) if self.response_cache else None
+        if entry:
+            if max_age and time.time() - entry["fetched_at"] < max_age:
+                return entry["value"]
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = self._send("GET", req_url, headers=headers, params=params)
+
+        if entry and response.status_code == 304:
+            self.log.debug("%s has not been modified, serving it from the cache", cache_key)
+            self.response_cache.refresh(cache_key)
+            return entry["value"]
 
         self._validate_response_status_code(response, 200, req_url, "GET")
 
-        response_body = response.json()
-        return response_body["shipments"]
+        value = extract(fast_json.loads(response.content))
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if self.response_cache and (etag or last_modified or max_age):
+            self.response_cache.put(cache_key, value, etag, last_modified)
+
+        return value
 
     def _validate_response_status_code(self, response, expected_status, req_url, req_method):
         if response.status_code != expected_status:
@@ -202,4 +527,22 @@ class LightspeedClient:
                 f"Expected code {expected_status}\n"
                 f"Response body: {response.content}"
             )
+            if response.status_code >= 500:
+                raise LightspeedUnavailableException(err_message)
             raise UnexpectedHTTPStatusCodeException(err_message)
+
+
+def _parse_rate_limit(headers):
+    """
+    Parses Lightspeed rate limit headers, which hold values of 5 minutes, hour and day windows, e.g. '300/3000/12000'.
+    :param headers: response headers
+    :return: dictionary with 'limit', 'remaining' and 'reset' tuples, or None if the headers are missing
+    """
+    try:
+        return {
+            "limit": tuple(int(value) for value in headers["X-RateLimit-Limit"].split("/")),
+            "remaining": tuple(int(value) for value in headers["X-RateLimit-Remaining"].split("/")),
+            "reset": tuple(int(value) for value in headers["X-RateLimit-Reset"].split("/"))
+        }
+    except (KeyError, ValueError, AttributeError):
+        return None
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .async_logging import log_context
+from .exceptions import ProcessOrderException, UnexpectedHTTPStatusCodeException
+from .state_store import load_state, save_state
+
+"""Action, which sets 'paid' payment status of the order"""
+ACTION_SET_PAID = "set-paid"
+"""Minimum number of seconds between two saves of the pending actions within a run"""
+FLUSH_INTERVAL = 5
+
+log = logging.getLogger(__name__)
+
+
+class PostFinishQueue:
+    """
+    Background queue of actions, which have to be done once the order is created, e.g. setting its payment status.
+    Actions are executed by a pool of worker threads, so order creation is not blocked by them. Pending actions are
+    persisted into the state file at most once per flush interval and when the queue is closed, and the ones which
+    haven't succeeded are retried by the next run.
+    Lightspeed has no bulk endpoint for updating orders, so each action still costs a separate call.
+
+    :param lightspeed_client: (LightspeedClient) client used to execute actions
+    :param state_path: (str) path to the JSON file with pending actions
+    :param workers: (number) number of worker threads
+    :param max_attempts: (number) number of attempts per action within a single run
+    :param retry_delay: (number) delay in seconds before the first retry, doubled with every next attempt
+    :param flush_interval: (number) minimum number of seconds between two saves of the pending actions
+    """
+
+    def __init__(self, lightspeed_client, state_path, workers=4, max_attempts=3, retry_delay=1,
+                 flush_interval=FLUSH_INTERVAL):
+        self.lightspeed_client = lightspeed_client
+        self.state_path = state_path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # Serializes the saves, so an older snapshot never overwrites a newer one
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._flushed_at = time.monotonic()
+        self._stopped = threading.Event()
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = load_state(state_path, default={})
+
+        if self._pending:
+            log.info(f"Retrying {len(self._pending)} post-finish actions left by previous runs")
+            for action in list(self._pending.values()):
+                self._futures.append(self._executor.submit(self._execute, action))
+
+    def submit_set_paid(self, order_id):
+        """
+        Schedules setting 'paid' payment status of the order.
+        :param order_id: (number) id of the order
+        """
+        action = {"action": ACTION_SET_PAID, "order_id": order_id}
+
+        with self._lock:
+            self._pending[self._get_key(action)] = action
+            self._dirty = True
+        self._flush()
+
+        self._futures.append(self._executor.submit(self._execute, action))
+
+    def close(self, timeout=None):
+        """
+        Waits for scheduled actions to complete and stops worker threads. Failed actions stay in the state file. Once
+        the timeout passes, actions, which haven't started yet, are cancelled, running ones stop retrying, and all of
+        them stay in the state file as well.
+        :param timeout: (number) maximum number of seconds to wait, waits for all actions if None
+        :return: number of actions, which haven't succeeded
+        """
+        _, not_done = wait(self._futures, timeout=timeout)
+        if not_done:
+            log.warning(f"Post-finish actions haven't completed in {timeout:.1f}s, leaving them for the next run")
+            self._stopped.set()
+            for future in not_done:
+                future.cancel()
+        # Running actions are bounded by a single Lightspeed call, since they don't retry anymore
+        self._executor.shutdown(wait=True)
+
+        self._flush(force=True)
+        with self._lock:
+            pending_count = len(self._pending)
+
+        if pending_count:
+            log.warning(f"{pending_count} post-finish actions haven't succeeded, they will be retried by the next run")
+
+        return pending_count
+
+    def _execute(self, action):
+        with log_context(order_id=action["order_id"]):
+            self._execute_with_retries(action)
+
+    def _execute_with_retries(self, action):
+        delay = self.retry_delay
+        for attempt in range(1, self.max_attempts + 1):
+            if self._stopped.is_set():
+                return
+            try:
+                self._execute_once(action)
+            except (ProcessOrderException, UnexpectedHTTPStatusCodeException) as e:
+                log.warning(f"Attempt {attempt} of action {action['action']} for order {action['order_id']} "
+                            f"has failed.\nError: {e}")
+            except Exception as e:
+                # Any error must leave the action pending instead of killing the worker silently
+                log.error(f"Action {action['action']} for order {action['order_id']} has failed.\nError: {e}")
+            else:
+                with self._lock:
+                    self._pending.pop(self._get_key(action), None)
+                    self._dirty = True
+                self._flush()
+                return
+
+            if attempt < self.max_attempts:
+                self._stopped.wait(delay)
+                delay *= 2
+
+        log.error(f"Action {action['action']} for order {action['order_id']} has failed {self.max_attempts} times")
+
+    def _execute_once(self, action):
+        if action["action"] == ACTION_SET_PAID:
+            payment_status = {"order": {"paymentStatus": "paid"}}
+            order = self.lightspeed_client.update_order_payment_status(action["order_id"], payment_status)
+            if order["paymentStatus"] != "paid":
+                raise ProcessOrderException(f"Payment status of order {action['order_id']} "
+                                            f"is '{order['paymentStatus']}'")
+        else:
+            raise ValueError(f"Unknown action {action['action']}")
+
+    def _flush(self, force=False):
+        """
+        Saves the pending actions, if they have changed and the flush interval has passed since the last save. The
+        file is written outside of the lock, so the workers are not blocked by it.
+        :param force: (bool) if True, the pending actions are saved regardless of the flush interval
+        """
+        if not self._save_lock.acquire(blocking=force):
+            # Another thread is saving them right now, the changes are saved by the next flush
+            return
+        try:
+            with self._lock:
+                if not force and (not self._dirty or time.monotonic() - self._flushed_at < self.flush_interval):
+                    return
+                snapshot = dict(self._pending)
+                self._dirty = False
+                self._flushed_at = time.monotonic()
+            save_state(self.state_path, snapshot)
+        finally:
+            self._save_lock.release()
+
+    @staticmethod
+    def _get_key(action):
+        return f"{action['action']}:{action['order_id']}"
@@ -0,0 +1,38 @@
+import time
+
+
+class RunBudget:
+    """
+    Time budget of a single run, e.g. the interval between two cron slots. The run stops taking new work, once only
+    the reserve is left, which is spent on finishing the work in flight, uploading results and saving the state.
+
+    :param max_seconds: (number) duration of the run, not limited if None
+    :param reserve: (number) number of seconds kept for finishing the run
+    """
+
+    def __init__(self, max_seconds=None, reserve=0):
+        self.max_seconds = max_seconds
+        self.reserve = reserve
+        self._started_at = time.monotonic()
+
+    def get_remaining_seconds(self):
+        """
+        :return: number of seconds left for taking new work, None if the run is not limited
+        """
+        if self.max_seconds is None:
+            return None
+        return max(self.max_seconds - self.reserve - (time.monotonic() - self._started_at), 0)
+
+    def get_remaining_total_seconds(self):
+        """
+        :return: number of seconds left until the run must be over including the reserve, None if not limited
+        """
+        if self.max_seconds is None:
+            return None
+        return max(self.max_seconds - (time.monotonic() - self._started_at), 0)
+
+    def is_exhausted(self):
+        """
+        :return: True if no new work should be taken
+        """
+        return self.max_seconds is not None and self.get_remaining_seconds() <= 0
@@ -1,13 +1,26 @@
-import paramiko
+import io
 import logging
 import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .sftp_pool import SFTPChannelPool
 
 log = logging.getLogger(__name__)
 
+"""Suffix of the remote file, which is being uploaded"""
+UPLOAD_TMP_SUFFIX = ".part"
+"""Number of seconds after which a temporary file left behind by a killed run is removed"""
+STALE_UPLOAD_SECONDS = 60 * 60
+"""Maximum number of alternative names tried, if the uploaded file name is already taken"""
+MAX_NAME_ATTEMPTS = 100
+
 
 class SFTPClient:
     """
-    Creates a SFTP client channel to host.
+    Client of the SFTP server. Operations are executed with channels of a pool, so they can run in parallel, and
+    survive dropped sessions.
 
     :param host: (str) STFP server address
     :param port: (number) SFTP server port
@@ -16,32 +29,29 @@ class SFTPClient:
     :param input_dir: (str) input folder located on SFTP server to fetch files from
     :param output_dir: (str) output folder located on SFTP server to place files into
     :param archive_dir: (str) archive folder located on SFTP server to place files into
+    :param channels: (number) maximum number of SFTP channels used in parallel
+    :param keepalive: (number) number of seconds between keepalive packets, 0 disables them
     """
 
-    def __init__(self, host, port, username, password, input_dir, output_dir, archive_dir):
+    def __init__(self, host, port, username, password, input_dir, output_dir, archive_dir, channels=4,
+                 keepalive=30):
         self.host = host
         self.port = port
         self.username = username
-        self.password = password
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.archive_dir = archive_dir
-        self.sftp = self._init_client()
-
-    def _init_client(self):
-        log.info("Connecting to %s:%s as user %s", self.host, self.port, self.username)
-
-        transport = paramiko.Transport((self.host, self.port))
-        transport.connect(username=self.username, password=self.password)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-
-        return sftp
+        self.channels = channels
+        self.pool = SFTPChannelPool(host, port, username, password, channels, keepalive)
+        self._swept_dirs = set()
 
     def _list_files(self, target_dir):
-        return map(
-            lambda file_name: os.path.join(target_dir, file_name),
-            self.sftp.listdir(target_dir)
-        )
+        # Files being uploaded are not complete yet
+        return [
+            os.path.join(target_dir, file_name)
+            for file_name in self.pool.run(lambda sftp: sftp.listdir(target_dir))
+            if not file_name.endswith(UPLOAD_TMP_SUFFIX)
+        ]
 
     def list_input_files(self):
         """
@@ -57,14 +67,45 @@ class SFTPClient:
         """
         return self._list_files(self.output_dir)
 
+    def list_archived_files(self, modified_since=None):
+        """
+        List files of SFTP 'archive_dir' directory, i.e. processed exported orders and archived order confirmations.
+        :param modified_since: (number) seconds since the epoch, older files are omitted if set
+        :return: an array of absolute paths of the files on SFTP server
+        """
+        attributes = self.pool.run(lambda sftp: sftp.listdir_attr(self.archive_dir))
+        return [
+            os.path.join(self.archive_dir, file.filename)
+            for file in attributes
+            if modified_since is None or file.st_mtime is None or file.st_mtime >= modified_since
+        ]
+
     def get_file(self, path):
         """
-        Gets file content for a given path on SFTP server. Note, that the file is NOT downloaded. The caller is
-        responsible for closing the underlying stream.
+        Downloads file for a given path on SFTP server into memory, so no channel is held while the file is being
+        processed. The caller is responsible for closing the returned stream.
         :param path: (str) absolute path to the file on SFTP server
-        :return: content of the requested file
+        :return: text stream with content of the requested file
+        """
+
+        def download(sftp):
+            buffer = io.BytesIO()
+            sftp.getfo(path, buffer)
+            return buffer.getvalue()
+
+        return io.StringIO(self.pool.run(download).decode("utf-8"), newline="")
+
+    def get_files(self, paths):
+        """
+        Downloads files in parallel, using up to 'channels' SFTP channels.
+        :param paths: (list) absolute paths to the files on SFTP server
+        :return: a list of text streams in the order of paths
         """
-        return self.sftp.open(path)
+        if len(paths) <= 1 or self.channels <= 1:
+            return [self.get_file(path) for path in paths]
+
+        with ThreadPoolExecutor(max_workers=min(self.channels, len(paths))) as executor:
+            return list(executor.map(self.get_file, paths))
 
     def archive_file(self, path):
         """
@@ -74,23 +115,101 @@ class SFTPClient:
         file_name = os.path.basename(path)
         target_dir = os.path.join(self.archive_dir, file_name)
 
-        log.debug(f"Archiving file {path} to {target_dir}")
-        self.sftp.rename(path, target_dir)
+        log.debug("Archiving file %s to %s", path, target_dir)
+        try:
+            self.pool.run(lambda sftp: sftp.rename(path, target_dir))
+        except IOError:
+            # Rename sent before the session has been dropped may have succeeded already
+            if self._exists(path) or not self._exists(target_dir):
+                raise
+
+    def _exists(self, path):
+        return self._get_size(path) is not None
 
-    def _upload_file(self, source_path, dest_path):
-        log.debug(f"Uploading {source_path} into SFTP {dest_path}")
-        self.sftp.put(source_path, dest_path)
+    def _get_size(self, path):
+        try:
+            return self.pool.run(lambda sftp: sftp.stat(path)).st_size
+        except IOError:
+            return None
 
-    def upload_processed_orders(self, processed_orders_csv_path: str):
+    def _remove_stale_uploads(self, target_dir):
+        """
+        Removes temporary files, which have been left behind by killed runs. Only files not modified for
+        STALE_UPLOAD_SECONDS are removed, so uploads in flight of the other modules are kept.
         """
-        Uploads CSV file with processed orders into the 'output_dir' folder on SFTP server
-        :param processed_orders_csv_path: (str) absolute path to the file with processed orders
+        oldest = time.time() - STALE_UPLOAD_SECONDS
+        for file in self.pool.run(lambda sftp: sftp.listdir_attr(target_dir)):
+            if not file.filename.endswith(UPLOAD_TMP_SUFFIX) or file.st_mtime is None or file.st_mtime >= oldest:
+                continue
+
+            path = os.path.join(target_dir, file.filename)
+            log.warning("Removing stale temporary file %s", path)
+            try:
+                self.pool.run(lambda sftp: sftp.remove(path))
+            except IOError as e:
+                log.warning("Failed to remove stale temporary file %s: %s", path, e)
+
+    def _upload_file(self, content: bytes, dest_dir, file_name):
         """
-        file_name = os.path.basename(processed_orders_csv_path)
-        target_dir = os.path.join(self.output_dir, file_name)
+        Uploads content under a temporary name, and then renames it into the destination folder, so the file is never
+        visible half-written. If the file name is already taken, e.g. two files have been created within the same
+        minute, '_<number>' suffix is added to the name. The temporary name is unique per upload, since the offloader
+        and the status checker may upload files of the same name at the same time.
+        :return: path to the uploaded file on SFTP server
+        """
+        if dest_dir not in self._swept_dirs:
+            self._swept_dirs.add(dest_dir)
+            self._remove_stale_uploads(dest_dir)
+
+        name, extension = os.path.splitext(file_name)
+        tmp_name = f"{file_name}.{os.getpid()}.{uuid.uuid4().hex}{UPLOAD_TMP_SUFFIX}"
+        tmp_path = os.path.join(dest_dir, tmp_name)
+
+        log.debug("Uploading %s bytes into SFTP %s", len(content), tmp_path)
+        self.pool.run(lambda sftp: sftp.putfo(io.BytesIO(content), tmp_path))
+
+        for attempt in range(MAX_NAME_ATTEMPTS):
+            candidate_name = f"{name}_{attempt}{extension}" if attempt else file_name
+            dest_path = os.path.join(dest_dir, candidate_name)
+            if self._exists(dest_path):
+                continue
+
+            try:
+                # SFTP rename fails if the destination exists, so a file uploaded concurrently is never overwritten
+                self.pool.run(lambda sftp: sftp.rename(tmp_path, dest_path))
+            except IOError:
+                # The temporary file is gone, if the rename sent before the session has been dropped has succeeded
+                if not self._exists(tmp_path):
+                    if self._get_size(dest_path) != len(content):
+                        raise IOError(f"{tmp_path} is gone, but {dest_path} doesn't hold the uploaded content")
+                    log.debug("Renamed %s into %s", tmp_path, dest_path)
+                    return dest_path
+                if self._exists(dest_path):
+                    continue
+                raise
+
+            log.debug("Renamed %s into %s", tmp_path, dest_path)
+            return dest_path
+
+        self.pool.run(lambda sftp: sftp.remove(tmp_path))
+        raise IOError(f"Cannot find a free name for {file_name} in {dest_dir}")
+
+    def upload_processed_orders(self, file_name: str, content: bytes):
+        """
+        Atomically uploads CSV file with processed orders into the 'output_dir' folder on SFTP server
+        :param file_name: (str) name of the file with processed orders
+        :param content: (bytes) content of the file
+        :return: path to the uploaded file on SFTP server
+        """
+        return self._upload_file(content, self.output_dir, file_name)
 
-        self._upload_file(processed_orders_csv_path, target_dir)
+    def close(self):
+        """
+        Closes all the SFTP channels and the connection.
+        """
+        self.pool.close()
 
     def __del__(self):
-        if self.sftp:
-            self.sftp.close()
+        pool = getattr(self, "pool", None)
+        if pool:
+            pool.close()
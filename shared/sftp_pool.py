@@ -0,0 +1,142 @@
+import logging
+import queue
+import socket
+import threading
+from contextlib import contextmanager
+
+import paramiko
+
+log = logging.getLogger(__name__)
+
+
+class SFTPChannelPool:
+    """
+    Pool of SFTP channels opened over a single authenticated transport. Channels are handed out to concurrent workers,
+    the transport sends keepalive packets, so long runs don't die on an idle timeout, and it is reopened, if the session
+    has been dropped.
+
+    :param host: (str) STFP server address
+    :param port: (number) SFTP server port
+    :param username: (str) username to connect to SFTP server
+    :param password: (str) password for connection to SFTP server
+    :param max_channels: (number) maximum number of channels open at the same time
+    :param keepalive: (number) number of seconds between keepalive packets, 0 disables them
+    """
+
+    def __init__(self, host, port, username, password, max_channels=4, keepalive=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_channels = max_channels
+        self.keepalive = keepalive
+        self._transport = None
+        self._idle_channels = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_channels)
+        self._lock = threading.Lock()
+        self._connect()
+
+    def run(self, operation, retry=True):
+        """
+        Executes the operation with a pooled channel. If the session has been dropped meanwhile, reconnects and
+        executes the operation once more.
+        :param operation: (function) takes paramiko.SFTPClient, and returns the result of the operation
+        :param retry: (bool) if False, the operation is not executed again after reconnect, e.g. it isn't idempotent
+        :return: result of the operation
+        """
+        try:
+            with self.channel() as sftp:
+                return operation(sftp)
+        except (EOFError, socket.error, paramiko.SSHException) as e:
+            if not retry or not self._is_dropped(e):
+                raise
+            log.warning(f"SFTP session has been dropped, reconnecting.\nError: {e}")
+
+        with self.channel() as sftp:
+            return operation(sftp)
+
+    @contextmanager
+    def channel(self):
+        """
+        Hands out an idle channel or opens a new one. The channel is returned into the pool afterwards, unless
+        the session has been dropped.
+        :return: context manager providing paramiko.SFTPClient
+        """
+        with self._slots:
+            sftp = self._acquire()
+            try:
+                yield sftp
+            except BaseException as e:
+                if self._is_dropped(e):
+                    self._discard(sftp)
+                else:
+                    self._idle_channels.put(sftp)
+                raise
+            self._idle_channels.put(sftp)
+
+    def close(self):
+        """
+        Closes all the channels and the transport.
+        """
+        with self._lock:
+            self._close_idle_channels()
+            if self._transport:
+                self._transport.close()
+                self._transport = None
+
+    def _acquire(self):
+        while True:
+            try:
+                sftp = self._idle_channels.get_nowait()
+            except queue.Empty:
+                break
+            if sftp.get_channel().get_transport().is_active():
+                return sftp
+            sftp.close()
+
+        with self._lock:
+            if not self._transport or not self._transport.is_active():
+                self._close_idle_channels()
+                self._connect()
+            transport = self._transport
+        return paramiko.SFTPClient.from_transport(transport)
+
+    def _discard(self, sftp):
+        """
+        Closes the channel of a dropped session together with its transport, so the next channel reconnects.
+        :param sftp: (paramiko.SFTPClient) channel, which has failed
+        """
+        transport = sftp.get_channel().get_transport()
+        sftp.close()
+        with self._lock:
+            if transport is self._transport:
+                self._close_idle_channels()
+                self._transport.close()
+                self._transport = None
+
+    def _connect(self):
+        log.info("Connecting to %s:%s as user %s", self.host, self.port, self.username)
+
+        transport = paramiko.Transport((self.host, self.port))
+        transport.connect(username=self.username, password=self.password)
+        if self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        self._transport = transport
+
+    def _close_idle_channels(self):
+        while True:
+            try:
+                self._idle_channels.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _is_dropped(self, error):
+        """
+        Distinguishes dropped session from SFTP errors, e.g. missing file, which are IOError as well.
+        :param error: raised exception
+        :return: boolean value
+        """
+        if isinstance(error, (EOFError, paramiko.SSHException)):
+            return True
+        transport = self._transport
+        return isinstance(error, socket.error) and (transport is None or not transport.is_active())
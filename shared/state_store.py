@@ -0,0 +1,44 @@
+"""
+This module contains helpers to persist small pieces of application state between runs as JSON files.
+"""
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+def load_state(path: str, default=None):
+    """
+    Loads state previously saved by save_state.
+    :param path: path to the JSON file
+    :param default: value to return if the file doesn't exist or cannot be parsed
+    :return: deserialized state
+    """
+    if not os.path.exists(path):
+        return default
+
+    try:
+        with open(path, "rt", encoding="utf8") as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        log.error(f"Cannot load state from {path}, starting with an empty state.\nError: {e}")
+
+    return default
+
+
+def save_state(path: str, state):
+    """
+    Atomically saves state into the JSON file, i.e. the file contains either previous or new state, even if the
+    process is killed while writing. Parent folders are created if needed.
+    :param path: path to the JSON file
+    :param state: JSON serializable state
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wt", encoding="utf8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,232 @@
+"""
+This module contains a lightweight tracing layer. Spans are exported in Chrome trace-event format, and can be opened
+in chrome://tracing or https://ui.perfetto.dev. Tracing is disabled unless the 'profiling' context is active, in which
+case every span costs a couple of dictionary operations.
+
+Three kinds of spans are available:
+ - span: coarse phase of the run, e.g. listing or uploading files, always recorded
+ - row_span: processing of a single row or order, only every N-th one is sampled
+ - phase: step of the row processing, e.g. a single API call, recorded only within a sampled row
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .async_logging import log_context
+
+log = logging.getLogger(__name__)
+
+"""Active tracer, None if tracing is disabled"""
+_tracer = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Collects spans as Chrome trace events.
+
+    :param row_sample_rate: (number) every row_sample_rate-th row span is recorded together with its phases
+    """
+
+    def __init__(self, row_sample_rate=100):
+        self.row_sample_rate = max(1, row_sample_rate)
+        self._events = []
+        self._phase_totals = {}
+        self._sampled_rows = 0
+        self._row_counter = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add_event(name, start, time.perf_counter(), args)
+
+    @contextmanager
+    def row_span(self, name, **args):
+        with self._lock:
+            sampled = self._row_counter % self.row_sample_rate == 0
+            self._row_counter += 1
+
+        if not sampled:
+            yield
+            return
+
+        self._local.row_sampled = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.row_sampled = False
+            end = time.perf_counter()
+            self._add_event(name, start, end, args)
+            self._add_phase_time(name, end - start)
+            with self._lock:
+                self._sampled_rows += 1
+
+    @contextmanager
+    def phase(self, name, **args):
+        if not getattr(self._local, "row_sampled", False):
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._add_event(name, start, end, args)
+            self._add_phase_time(name, end - start)
+
+    def save(self, path):
+        """
+        Saves collected spans into the JSON file in Chrome trace-event format.
+        :param path: (str) path to the output file
+        """
+        with self._lock:
+            trace = {"traceEvents": list(self._events), "displayTimeUnit": "ms"}
+
+        with open(path, "wt", encoding="utf8") as f:
+            json.dump(trace, f)
+
+    def log_row_breakdown(self):
+        """
+        Logs average duration of the sampled rows and their phases.
+        """
+        with self._lock:
+            sampled_rows = self._sampled_rows
+            phase_totals = dict(self._phase_totals)
+
+        if not sampled_rows:
+            return
+
+        log.info(f"Timing breakdown of {sampled_rows} sampled rows (1 of {self.row_sample_rate}):")
+        for name, (total, count) in sorted(phase_totals.items(), key=lambda item: -item[1][0]):
+            log.info(f"  {name}: {count} calls, {total / sampled_rows * 1000:.1f} ms per row, "
+                     f"{total / count * 1000:.1f} ms per call")
+
+    def _add_event(self, name, start, end, args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self._pid,
+            "tid": threading.get_ident()
+        }
+        if args:
+            event["args"] = {key: str(value) for key, value in args.items()}
+
+        with self._lock:
+            self._events.append(event)
+
+    def _add_phase_time(self, name, duration):
+        with self._lock:
+            total, count = self._phase_totals.get(name, (0, 0))
+            self._phase_totals[name] = (total + duration, count + 1)
+
+
+def span(name, **args):
+    """
+    Context manager recording a coarse phase of the run.
+    :param name: (str) name of the span
+    :param args: additional attributes of the span
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, **args)
+
+
+def row_span(name, **args):
+    """
+    Context manager recording processing of a single row, if the row is sampled.
+    :param name: (str) name of the span
+    :param args: additional attributes of the span
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.row_span(name, **args)
+
+
+def phase(name, **args):
+    """
+    Context manager recording a step of the sampled row processing.
+    :param name: (str) name of the span
+    :param args: additional attributes of the span
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.phase(name, **args)
+
+
+def traced_phase(name):
+    """
+    Decorator recording every call of the decorated function as a phase of the sampled row. The name is also added
+    into the log context as 'phase'.
+    :param name: (str) name of the span
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with log_context(phase=name), phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profiling(output_dir, name, row_sample_rate=100):
+    """
+    Enables tracing and cProfile for the enclosed code. On exit saves '<name>-trace.json' and '<name>.pstats' into
+    output_dir, and logs timing breakdown of the sampled rows. Does nothing if output_dir is None.
+    :param output_dir: (str) folder to store profiling results into
+    :param name: (str) prefix of the output files
+    :param row_sample_rate: (number) every row_sample_rate-th row is traced together with its phases
+    """
+    global _tracer
+
+    if output_dir is None:
+        yield
+        return
+
+    import cProfile
+
+    os.makedirs(output_dir, exist_ok=True)
+    _tracer = Tracer(row_sample_rate)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        with _tracer.span(name):
+            yield
+    finally:
+        profiler.disable()
+        tracer, _tracer = _tracer, None
+
+        trace_path = os.path.join(output_dir, f"{name}-trace.json")
+        stats_path = os.path.join(output_dir, f"{name}.pstats")
+        tracer.save(trace_path)
+        profiler.dump_stats(stats_path)
+        tracer.log_row_breakdown()
+        log.info(f"Trace has been saved into {trace_path}, profile into {stats_path}")
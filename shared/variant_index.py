@@ -0,0 +1,27 @@
+"""
+This module contains helpers to build a compact index of Lightspeed product variants.
+"""
+
+
+def extract_variant_index_page(response_body):
+    """
+    Reduces a page of variants to a compact list of [EAN, id, stock] entries, which can be cached as JSON.
+    :param response_body: decoded page of variants
+    :return: dictionary with 'count' of variants on the page, and 'entries' containing [EAN, id, stock] entries
+    """
+    variants = response_body["variants"]
+    return {
+        "count": len(variants),
+        "entries": [[variant["ean"], variant["id"], get_available_stock(variant)]
+                    for variant in variants if variant.get("ean")]
+    }
+
+
+def get_available_stock(variant):
+    """
+    :param variant: decoded variant with 'stockTracking' and 'stockLevel' fields
+    :return: number of items, which can be ordered, or None if the stock is not tracked, i.e. it is always available
+    """
+    if variant.get("stockTracking") != "enabled":
+        return None
+    return variant.get("stockLevel") or 0
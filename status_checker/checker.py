@@ -1,124 +1,199 @@
 import logging
-import csv
 import os
-import re
-import shutil
 
-from shared import csv_writer
-from shared.exceptions import UnexpectedHTTPStatusCodeException
+from shared import csv_writer, tracing
+from shared.async_logging import log_context
+from shared.csv_reader import OrderConfirmation, read_order_confirmations
+from shared.run_budget import RunBudget
+from shared.exceptions import CircuitOpenException, CSVFormatException, UnexpectedHTTPStatusCodeException
 from shared.sftp_client import SFTPClient
 from shared.lightspeed_client import LightspeedClient
 from shared.const.csv_column_names import OrderConfirmationCSV
 from shared.const import order_statuses
-from shared.const import FILE_TIMESTAMP_PATTERN
+from .file_index import FileIndex
+from .poll_schedule import PollSchedule
+from .return_tracker import ReturnTracker
 
-"""Folder name in which temporary files are stored"""
-TMP_FOLDER = "tmp"
+log = logging.getLogger(__name__)
 
-"""Number of days after which the file can be archived"""
-FILE_ARCHIVE_PERIOD = 4
+"""Number of hours an output file stays in the output folder, so the ERP has time to pick up the shipped orders"""
+DEFAULT_ARCHIVE_MIN_AGE_HOURS = 96
 
-log = logging.getLogger(__name__)
 
+def _process_all_files(sftp_client: SFTPClient, lspeed_client: LightspeedClient, poll_schedule: PollSchedule = None,
+                       return_tracker: ReturnTracker = None, file_index: FileIndex = None, archive_min_age=0,
+                       run_budget: RunBudget = None):
+    """
+    Reads output files, which haven't been indexed yet, checks status of the outstanding orders of all the files,
+    uploads newly shipped and returned orders, and archives files without any outstanding order. Returned orders are
+    looked up even if the output folder is empty.
+    :param sftp_client: an instance of SFTPClient
+    :param lspeed_client: an instance of LightspeedClient
+    :param poll_schedule: an instance of PollSchedule deciding which orders are due for a check, may be None
+    :param return_tracker: an instance of ReturnTracker detecting returned orders, may be None
+    :param file_index: an instance of FileIndex kept between runs, every file is read by every run if None
+    :param archive_min_age: (number) minimum number of seconds since a file has been seen before it can be archived
+    :param run_budget: an instance of RunBudget, status checks stop once it is exhausted, not limited if None
+    """
+    file_index = file_index or FileIndex()
 
-def _process_all_files(sftp_client: SFTPClient, lspeed_client: LightspeedClient):
-    files_to_process = sftp_client.list_output_files()
+    with tracing.span("list output files"):
+        output_files = sftp_client.list_output_files()
 
-    if not files_to_process:
-        log.warning("No files to process.")
-        return
+    if not output_files:
+        # Returns of the orders, which files have already been archived, still have to be reported
+        log.info("No output files to process.")
 
-    orders_map = {}
-    for file_path in files_to_process:
+    file_index.retain(set(output_files))
+    files_to_read = [file_path for file_path in output_files if not file_index.is_indexed(file_path)]
+    log.info(f"Reading {len(files_to_read)} new files, {len(output_files) - len(files_to_read)} files are indexed.")
+
+    with tracing.span("download files", files=len(files_to_read)):
+        files = sftp_client.get_files(files_to_read)
+
+    shipped_order_ids = set()
+    for file_path, file in zip(files_to_read, files):
         log.info(f"Processing file {file_path}")
-        file = sftp_client.get_file(file_path)
 
-        all_orders_shipped = _process_file(file, orders_map)
+        try:
+            with tracing.span("parse file", file=file_path):
+                confirmed_orders = _process_file(file, shipped_order_ids, return_tracker)
+        except CSVFormatException as e:
+            log.error(f"Cannot parse file {file_path}, skipping it.\nError: {e}")
+            continue
+        finally:
+            file.close()
 
-        file.close()
+        file_index.add_file(file_path, confirmed_orders)
 
-        file_name = os.path.basename(file_path)
-        if all_orders_shipped and _is_file_older_than(file_name, FILE_ARCHIVE_PERIOD):
-            log.info(f"Archiving file {file_name}.")
-            sftp_client.archive_file(file_path)
+    file_index.mark_shipped(shipped_order_ids)
+    orders_map = file_index.get_outstanding_orders()
 
-    shipped_orders = _process_all_confirmed_orders(orders_map, lspeed_client)
+    with tracing.span("check confirmed orders", orders=len(orders_map)):
+        shipped_orders = _process_all_confirmed_orders(orders_map, lspeed_client, poll_schedule, run_budget)
+    file_index.mark_shipped({shipped_order.order_id for shipped_order in shipped_orders})
 
-    if shipped_orders:
-        log.debug(f"Saving {len(shipped_orders)} shipped orders into a CSV file.")
-        csv_path = csv_writer.save_orders_as_csv(TMP_FOLDER, shipped_orders, OrderConfirmationCSV.FIELDNAMES)
-        sftp_client.upload_processed_orders(csv_path)
-    else:
-        log.info("No new shipped order has been detected.")
+    returned_orders = []
+    if return_tracker:
+        for shipped_order in shipped_orders:
+            return_tracker.track_shipped(shipped_order)
+        with tracing.span("find returned orders"):
+            returned_orders = return_tracker.find_returned_orders(lspeed_client)
 
+    if not shipped_orders:
+        log.info("No new shipped order has been detected.")
+    if not returned_orders and return_tracker:
+        log.info("No new returned order has been detected.")
+
+    orders_to_save = shipped_orders + returned_orders
+    if orders_to_save:
+        log.debug(f"Saving {len(shipped_orders)} shipped and {len(returned_orders)} returned orders into a CSV file.")
+        with tracing.span("serialize orders as CSV", orders=len(orders_to_save)):
+            file_name, content = csv_writer.serialize_orders_as_csv(orders_to_save, OrderConfirmationCSV.FIELDNAMES)
+        with tracing.span("upload processed orders"):
+            uploaded_path = sftp_client.upload_processed_orders(file_name, content)
+        # The uploaded file has no outstanding order, so it never has to be read
+        file_index.add_file(uploaded_path, [])
+
+    for file_path in file_index.get_files_without_outstanding_orders(archive_min_age):
+        if file_path not in output_files:
+            continue
+        log.info(f"Archiving file {os.path.basename(file_path)}.")
+        with tracing.span("archive file", file=file_path):
+            sftp_client.archive_file(file_path)
+        file_index.remove(file_path)
 
-def _process_file(file, orders_map: dict):
-    file_reader = csv.DictReader(file, delimiter=";")
 
-    all_orders_shipped = True
-    for row in file_reader:
-        order_id = row[OrderConfirmationCSV.ORDER_ID]
-        order_status = row[OrderConfirmationCSV.STATUS]
+def _process_file(file, shipped_order_ids: set, return_tracker: ReturnTracker = None):
+    """
+    Parses output file.
+    :param file: file-like object containing order confirmations
+    :param shipped_order_ids: (set) ids of the orders, which are shipped according to the file, are added into it
+    :param return_tracker: an instance of ReturnTracker, which starts tracking the shipped orders, may be None
+    :return: a list of confirmation records of the confirmed orders
+    """
+    confirmed_orders = []
+    for row in read_order_confirmations(file):
+        order_status = row.status
 
         if order_status == order_statuses.SHIPPED:
-            orders_map[order_id] = False
-        elif order_status == order_statuses.CONFIRMED and order_id not in orders_map:
-            orders_map[order_id] = row
-            all_orders_shipped = False
+            shipped_order_ids.add(row.order_id)
+            if return_tracker:
+                return_tracker.track_shipped(row)
+        elif order_status == order_statuses.CONFIRMED:
+            confirmed_orders.append(row)
 
-    return all_orders_shipped
+    return confirmed_orders
 
 
-def _is_file_older_than(file_name: str, days: int = 4):
+def _process_all_confirmed_orders(orders_map: dict, lspeed_client: LightspeedClient,
+                                  poll_schedule: PollSchedule = None, run_budget: RunBudget = None):
     """
-    Checks if the file is older then the predefined number of days by parsing the timestamp in the name.
-    :param file_name: name of the file to check
-    :param days: number of days to compare against
-    :return: boolean value
+    Checks status of the confirmed orders, and creates shipped order for each of them, which has been shipped. Checks
+    stop as soon as the circuit breaker finds Lightspeed unavailable, or the run budget is exhausted.
+    :param orders_map: dictionary mapping order id to its confirmation record, or False if the order is shipped
+    :param lspeed_client: an instance of LightspeedClient
+    :param poll_schedule: an instance of PollSchedule deciding which orders are due for a check, all orders are
+    checked if None
+    :param run_budget: an instance of RunBudget, not limited if None
+    :return: an array of shipped orders
     """
-    from datetime import datetime, timedelta
-
+    shipped_orders = []
+    skipped_orders = 0
     try:
-        match_obj = re.match(r"(PO|S)-([0-9-]*)", file_name)
-        file_timestamp = match_obj.group(2)
-        timestamp = datetime.strptime(file_timestamp, FILE_TIMESTAMP_PATTERN)
-    except (ValueError, AttributeError) as e:
-        log.error(f"Cannot determine creation date for file {file_name}.\nError: {e}")
-    else:
-        return timestamp < datetime.now() - timedelta(days=days)
+        for order_id in orders_map:
+            order_details = orders_map[order_id]
+            if not order_details:
+                continue
 
-    return False
+            if poll_schedule and not poll_schedule.should_check(order_id):
+                skipped_orders += 1
+                continue
 
+            if run_budget and run_budget.is_exhausted():
+                log.warning("Run budget is exhausted, remaining orders will be checked by the next run.")
+                break
 
-def _process_all_confirmed_orders(orders_map: dict, lspeed_client: LightspeedClient):
-    shipped_orders = []
-    for order_id in orders_map:
-        order_details = orders_map[order_id]
-        if not order_details:
-            continue
+            log.debug("Processing order %s.", order_id)
+
+            with log_context(order_id=order_id), tracing.row_span("check order", order=order_id):
+                order_shipped = _is_order_shipped(order_details, lspeed_client)
 
-        log.debug(f"Processing order {order_id}.")
+                if order_shipped:
+                    log.debug("Order %s changed status to %s.", order_id, order_statuses.SHIPPED)
+                    tracking_code = _get_tracking_code(order_id, lspeed_client)
+                    shipped_order = _create_shipped_order(order_details, tracking_code)
+                    shipped_orders.append(shipped_order)
 
-        order_shipped = _is_order_shipped(order_details, lspeed_client)
+            if poll_schedule and order_shipped:
+                poll_schedule.record_shipped(order_id)
+            elif poll_schedule and order_shipped is not None:
+                poll_schedule.record_unchanged(order_id)
+    except CircuitOpenException as e:
+        log.error(f"Lightspeed is unavailable, stopping status checks until the next run.\nError: {e}")
 
-        if order_shipped:
-            log.debug(f"Order {order_id} changed status to {order_statuses.SHIPPED}.")
-            tracking_code = _get_tracking_code(order_id, lspeed_client)
-            shipped_order = _create_shipped_order(order_details, tracking_code)
-            shipped_orders.append(shipped_order)
+    if poll_schedule:
+        log.info(f"Skipped {skipped_orders} confirmed orders, which are not due for a status check.")
+        poll_schedule.retain({order_id for order_id, order_details in orders_map.items() if order_details})
 
     return shipped_orders
 
 
-def _is_order_shipped(order_details, lspeed_client: LightspeedClient):
-    order_id = order_details[OrderConfirmationCSV.ORDER_ID]
+def _is_order_shipped(order_details: OrderConfirmation, lspeed_client: LightspeedClient):
+    """
+    Checks if the order has been shipped.
+    :param order_details: order confirmation record
+    :param lspeed_client: an instance of LightspeedClient
+    :return: boolean value, or None if the status cannot be retrieved
+    """
+    order_id = order_details.order_id
     try:
         actual_order_status = lspeed_client.get_order_status(order_id)
         return actual_order_status == "completed_shipped"
     except UnexpectedHTTPStatusCodeException as e:
         log.error(f"Failed to check order {order_id} status.\nError: {str(e)}")
 
-    return False
+    return None
 
 
 def _get_tracking_code(order_id, lspeed_client: LightspeedClient):
@@ -135,21 +210,21 @@ def _get_tracking_code(order_id, lspeed_client: LightspeedClient):
     return None
 
 
-def _create_shipped_order(order_details: dict, tracking_code, shipment_carrier="GLS"):
-    order = order_details.copy()
-    order[OrderConfirmationCSV.STATUS] = order_statuses.SHIPPED
-    order[OrderConfirmationCSV.TRACKING_NUMBER] = tracking_code
-    order[OrderConfirmationCSV.SHIPMENT_CARRIER] = shipment_carrier
+def _create_shipped_order(order_details: OrderConfirmation, tracking_code, shipment_carrier="GLS"):
+    return order_details._replace(status=order_statuses.SHIPPED,
+                                  tracking_number=tracking_code,
+                                  shipment_carrier=shipment_carrier)
 
-    return order
 
-
-def run(config_path: str):
+def run(config_path: str, config_parser_factory=None, max_runtime=None):
     """
-    Runs status checker module. It starts with iterating over all order status CSV files, and building a hash map with
-    orders needs to be checked. After every order status has been checked, new file with the newly shipped orders is
-    created.
+    Runs status checker module. It starts with reading order status CSV files, which haven't been indexed by previous
+    runs, and collecting orders needs to be checked from the index. After every order status has been checked, new file
+    with the newly shipped orders is created, and files without any outstanding order are archived.
     :param config_path: path to the configuration YAML file
+    :param config_parser_factory: creates ConfigParser from the config path, e.g. a recording or replaying one,
+    defaults to ConfigParser
+    :param max_runtime: (number) number of seconds the run may take, not limited if None
     :return: status code 0 if terminated successfully, otherwise 1
     """
     from yaml import YAMLError
@@ -157,7 +232,7 @@ def run(config_path: str):
     from shared.config_parser import ConfigParser
 
     try:
-        config_parser = ConfigParser(config_path)
+        config_parser = (config_parser_factory or ConfigParser)(config_path)
     except YAMLError:
         log.critical(f"Failed to load config file {config_path}. Check the correctness of the config.")
         return 1
@@ -168,17 +243,28 @@ def run(config_path: str):
         log.critical(f"Cannot connect to SFTP server. Error message: {e}")
         return 1
 
-    lspeed_client = config_parser.create_lightspeed_client()
+    lspeed_client = config_parser.create_lightspeed_client("status_checker")
     if not lspeed_client or not sftp_client:
         return 1
 
-    # Create temp folder
-    log.debug(f"Creating temp '{TMP_FOLDER}' folder")
-    os.makedirs(TMP_FOLDER, exist_ok=True)
-
-    _process_all_files(sftp_client, lspeed_client)
+    config = config_parser.get_config()
+    poll_schedule = PollSchedule(config.get("poll-state-path", "./state/poll-schedule.json"),
+                                 base_interval=config.get("poll-base-interval-minutes", 120) * 60,
+                                 max_interval=config.get("poll-max-interval-minutes", 1440) * 60,
+                                 horizon=config.get("poll-horizon-days", 14) * 24 * 60 * 60)
+    return_tracker = ReturnTracker(config.get("returns-state-path", "./state/returns.json"),
+                                   horizon=config.get("returns-horizon-days", 60) * 24 * 60 * 60)
+    file_index = FileIndex(config.get("file-index-path", "./state/file-index.json"))
+    archive_min_age = config.get("archive-min-age-hours", DEFAULT_ARCHIVE_MIN_AGE_HOURS) * 60 * 60
+    run_budget = RunBudget(max_runtime, config.get("run-budget-reserve-seconds", 120)) if max_runtime else None
 
-    log.debug(f"Removing temp '{TMP_FOLDER}' folder")
-    shutil.rmtree(TMP_FOLDER)
+    try:
+        _process_all_files(sftp_client, lspeed_client, poll_schedule, return_tracker, file_index, archive_min_age,
+                           run_budget)
+    finally:
+        file_index.save()
+        lspeed_client.save_cache()
+        poll_schedule.save()
+        return_tracker.save()
 
     return 0
@@ -0,0 +1,87 @@
+import logging
+import time
+
+from shared.csv_reader import OrderConfirmation
+from shared.state_store import load_state, save_state
+
+log = logging.getLogger(__name__)
+
+
+class FileIndex:
+    """
+    Keeps outstanding, i.e. confirmed but not shipped, orders of every output file between runs. Output files are
+    never changed once uploaded, so every file is read only once, and the checker works with the index afterwards.
+    A file can be archived as soon as it has no outstanding order.
+
+    :param state_path: (str) path to the JSON file with the index, the index is kept in memory only if None
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        state = load_state(state_path, default={}) if state_path else {}
+        self._files = state.get("files", {})
+
+    def is_indexed(self, file_path):
+        return file_path in self._files
+
+    def add_file(self, file_path, outstanding_orders):
+        """
+        Adds a file, which has been read for the first time.
+        :param file_path: (str) path to the file on SFTP server
+        :param outstanding_orders: (list) confirmation records of the orders, which are not known to be shipped
+        """
+        self._files[file_path] = {
+            "first_seen": time.time(),
+            "orders": {order.order_id: list(order) for order in outstanding_orders}
+        }
+
+    def mark_shipped(self, order_ids):
+        """
+        Removes shipped orders from the outstanding orders of every file.
+        :param order_ids: collection of ids of the shipped orders
+        """
+        for file in self._files.values():
+            for order_id in order_ids:
+                file["orders"].pop(order_id, None)
+
+    def retain(self, file_paths):
+        """
+        Removes files, which are not in the output folder anymore, e.g. they have been archived by hand.
+        :param file_paths: collection of paths of the files in the output folder
+        """
+        for file_path in list(self._files):
+            if file_path not in file_paths:
+                del self._files[file_path]
+
+    def get_outstanding_orders(self):
+        """
+        Returns outstanding orders of all the files. If an order is confirmed by several files, the record of the file
+        seen first is returned.
+        :return: dictionary mapping order id to its confirmation record
+        """
+        outstanding_orders = {}
+        for file in sorted(self._files.values(), key=lambda file: file["first_seen"]):
+            for order_id, row in file["orders"].items():
+                if order_id not in outstanding_orders:
+                    outstanding_orders[order_id] = OrderConfirmation._make(row)
+        return outstanding_orders
+
+    def get_files_without_outstanding_orders(self, min_age=0):
+        """
+        Returns files, which can be archived.
+        :param min_age: (number) minimum number of seconds since the file has been seen for the first time
+        :return: a list of paths to the files
+        """
+        now = time.time()
+        return [file_path for file_path, file in self._files.items()
+                if not file["orders"] and now - file["first_seen"] >= min_age]
+
+    def remove(self, file_path):
+        self._files.pop(file_path, None)
+
+    def save(self):
+        """
+        Saves the index into the state file.
+        """
+        if self.state_path:
+            save_state(self.state_path, {"files": self._files})
@@ -0,0 +1,121 @@
+import logging
+import time
+
+from shared.state_store import load_state, save_state
+
+"""Number of observed shipping times needed before the distribution replaces configured intervals"""
+MIN_SHIPPING_SAMPLES = 20
+"""Maximum number of observed shipping times kept in the state"""
+MAX_SHIPPING_SAMPLES = 500
+"""Orders scheduled to be checked within this number of seconds after now are checked by the current run"""
+CHECK_TOLERANCE = 5 * 60
+
+log = logging.getLogger(__name__)
+
+
+class PollSchedule:
+    """
+    Decides which confirmed orders are worth checking by the current run, and keeps per-order next-check times between
+    runs. Order age is counted from the moment the checker has seen the order for the first time.
+     - Orders younger than the 10th percentile of observed shipping times are not checked until they reach that age.
+     - Orders within the usual shipping window, i.e. up to the 90th percentile, are checked every base interval.
+     - Older orders are backed off exponentially with every check, which hasn't observed any change.
+     - Orders older than the horizon are flagged as stale, and are not checked anymore.
+
+    :param state_path: (str) path to the JSON file with the schedule state
+    :param base_interval: (number) number of seconds between checks of an order within the usual shipping window
+    :param max_interval: (number) maximum number of seconds between checks of an order
+    :param horizon: (number) number of seconds after which an order is flagged as stale
+    """
+
+    def __init__(self, state_path, base_interval=2 * 60 * 60, max_interval=24 * 60 * 60, horizon=14 * 24 * 60 * 60):
+        self.state_path = state_path
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.horizon = horizon
+
+        state = load_state(state_path, default={})
+        self._orders = state.get("orders", {})
+        self._shipping_times = state.get("shipping_times", [])
+        self._window = self._get_shipping_window()
+
+    def should_check(self, order_id):
+        """
+        Checks if the order is due for a status check. Registers the order, if it has been seen for the first time.
+        :param order_id: (str) id of the order
+        :return: boolean value
+        """
+        now = time.time()
+        order = self._orders.get(order_id)
+        if order is None:
+            order = {"first_seen": now, "next_check": now + self._window[0], "unchanged": 0, "stale": False}
+            self._orders[order_id] = order
+
+        if order["stale"]:
+            return False
+
+        if now - order["first_seen"] > self.horizon:
+            order["stale"] = True
+            log.warning(f"Order {order_id} hasn't been shipped within {self.horizon // 86400} days, "
+                        f"flagging it as stale and stopping to check its status.")
+            return False
+
+        return order["next_check"] <= now + CHECK_TOLERANCE
+
+    def record_unchanged(self, order_id):
+        """
+        Records that the order status hasn't changed, and schedules the next check.
+        :param order_id: (str) id of the order
+        """
+        now = time.time()
+        order = self._orders[order_id]
+        order["unchanged"] += 1
+
+        age = now - order["first_seen"]
+        if age < self._window[0]:
+            next_check = order["first_seen"] + self._window[0]
+        elif age < self._window[1]:
+            next_check = now + self.base_interval
+        else:
+            backoff = self.base_interval * 2 ** min(order["unchanged"], 16)
+            next_check = now + min(backoff, self.max_interval)
+        order["next_check"] = next_check
+
+    def record_shipped(self, order_id):
+        """
+        Records that the order has been shipped, and adds its shipping time into the observed distribution.
+        :param order_id: (str) id of the order
+        """
+        order = self._orders.pop(order_id, None)
+        if order is None:
+            return
+
+        self._shipping_times.append(time.time() - order["first_seen"])
+        del self._shipping_times[:-MAX_SHIPPING_SAMPLES]
+
+    def retain(self, order_ids):
+        """
+        Removes orders, which aren't confirmed anymore, e.g. they have been shipped or their files archived.
+        :param order_ids: collection of ids of the confirmed orders
+        """
+        for order_id in list(self._orders):
+            if order_id not in order_ids:
+                del self._orders[order_id]
+
+    def save(self):
+        """
+        Saves the schedule into the state file.
+        """
+        save_state(self.state_path, {"orders": self._orders, "shipping_times": self._shipping_times})
+
+    def _get_shipping_window(self):
+        """
+        Estimates the usual shipping window from the observed shipping times.
+        :return: (earliest, latest) tuple of order ages in seconds, i.e. 10th and 90th percentile of shipping times
+        """
+        if len(self._shipping_times) < MIN_SHIPPING_SAMPLES:
+            return 0, self.horizon
+
+        shipping_times = sorted(self._shipping_times)
+        last_index = len(shipping_times) - 1
+        return shipping_times[last_index // 10], shipping_times[last_index * 9 // 10]
@@ -0,0 +1,148 @@
+import logging
+import re
+import time
+from datetime import datetime
+
+from shared.const import order_statuses
+from shared.csv_reader import OrderConfirmation
+from shared.exceptions import CircuitOpenException, UnexpectedHTTPStatusCodeException
+from shared.state_store import load_state, save_state
+
+"""Every query overlaps the previous one by this number of seconds, so returns are not missed because of clock skew or
+shop time zone. Returns seen within the overlap are recognized by their ids"""
+CURSOR_OVERLAP = 24 * 60 * 60
+"""Format of the time filters accepted by Lightspeed API"""
+LIGHTSPEED_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+log = logging.getLogger(__name__)
+
+
+class ReturnTracker:
+    """
+    Detects returns of the shipped orders without polling every shipped order. Shipped orders are remembered until
+    the return horizon passes, and a single incremental query fetches the returns updated since the previous run.
+    The cursor, i.e. time of the last successful query, is kept between runs. Returns of orders, which are not tracked
+    yet, e.g. since their shipped rows haven't been read yet, are kept until the horizon passes, and reported once the
+    order is tracked.
+
+    :param state_path: (str) path to the JSON file with the tracker state
+    :param horizon: (number) number of seconds a shipped order is tracked for returns
+    """
+
+    def __init__(self, state_path, horizon=60 * 24 * 60 * 60):
+        self.state_path = state_path
+        self.horizon = horizon
+
+        state = load_state(state_path, default={})
+        self._cursor = state.get("cursor")
+        self._shipped_orders = state.get("shipped_orders", {})
+        self._seen_returns = state.get("seen_returns", {})
+        self._untracked_returns = state.get("untracked_returns", {})
+
+    def track_shipped(self, order: OrderConfirmation):
+        """
+        Starts tracking the shipped order for returns. Already tracked orders, including the returned ones, are ignored,
+        since shipped rows stay in the output files after the return has been reported.
+        :param order: (OrderConfirmation) shipped order record
+        """
+        if order.order_id not in self._shipped_orders:
+            self._shipped_orders[order.order_id] = {"row": list(order), "shipped_at": time.time()}
+
+    def find_returned_orders(self, lspeed_client):
+        """
+        Fetches the returns updated since the previous query, and creates a returned order record for every tracked
+        order, which has been returned. Every order is reported as returned only once.
+        :param lspeed_client: an instance of LightspeedClient
+        :return: an array of returned orders
+        """
+        query_started_at = time.time()
+        since = (self._cursor if self._cursor is not None else query_started_at) - CURSOR_OVERLAP
+        if self._cursor is None:
+            log.warning(f"Returns have never been queried, looking up returns updated since "
+                        f"{time.strftime(LIGHTSPEED_TIME_FORMAT, time.gmtime(since))} UTC, older returns are not "
+                        f"reported")
+        try:
+            returns = lspeed_client.get_returns_updated_since(time.strftime(LIGHTSPEED_TIME_FORMAT, time.gmtime(since)))
+        except (CircuitOpenException, UnexpectedHTTPStatusCodeException) as e:
+            log.error(f"Failed to retrieve returns, they will be retrieved by the next run.\nError: {str(e)}")
+            return []
+
+        for lspeed_return in returns:
+            return_id = str(lspeed_return["id"])
+            if return_id in self._seen_returns or return_id in self._untracked_returns:
+                continue
+            self._untracked_returns[return_id] = {
+                "order_id": _get_order_id(lspeed_return),
+                "updated_at": _parse_time(lspeed_return.get("updatedAt")) or query_started_at
+            }
+
+        returned_orders = []
+        for return_id, lspeed_return in list(self._untracked_returns.items()):
+            order_id = lspeed_return["order_id"]
+            order = self._shipped_orders.get(order_id)
+            if order is None:
+                # The order may be tracked by a later run, once its shipped row is read
+                continue
+
+            del self._untracked_returns[return_id]
+            self._seen_returns[return_id] = lspeed_return["updated_at"]
+            if order.get("returned"):
+                continue
+            order["returned"] = True
+
+            log.debug("Order %s changed status to %s.", order_id, order_statuses.RETURNED)
+            returned_orders.append(OrderConfirmation._make(order["row"])._replace(status=order_statuses.RETURNED))
+
+        self._cursor = query_started_at
+        return returned_orders
+
+    def save(self):
+        """
+        Forgets orders shipped before the horizon, returns of untracked orders updated before the horizon, and
+        reported returns older than the query overlap, and saves the tracker into the state file.
+        """
+        now = time.time()
+        self._shipped_orders = {order_id: order for order_id, order in self._shipped_orders.items()
+                                if now - order["shipped_at"] <= self.horizon}
+        self._untracked_returns = {return_id: lspeed_return
+                                   for return_id, lspeed_return in self._untracked_returns.items()
+                                   if now - lspeed_return["updated_at"] <= self.horizon}
+        if self._cursor is not None:
+            self._seen_returns = {return_id: updated_at for return_id, updated_at in self._seen_returns.items()
+                                  if updated_at >= self._cursor - CURSOR_OVERLAP}
+
+        save_state(self.state_path, {"cursor": self._cursor,
+                                     "shipped_orders": self._shipped_orders,
+                                     "seen_returns": self._seen_returns,
+                                     "untracked_returns": self._untracked_returns})
+
+
+def _get_order_id(lspeed_return):
+    """
+    Extracts id of the returned order from the embedded order resource link.
+    :param lspeed_return: return object
+    :return: (str) order id, or None if the return doesn't reference any order
+    """
+    order = lspeed_return.get("order")
+    if not isinstance(order, dict):
+        return None
+
+    order_id = order.get("resource", order).get("id")
+    return str(order_id) if order_id is not None else None
+
+
+def _parse_time(value):
+    """
+    Parses Lightspeed timestamp, e.g. '2020-03-01T12:00:00+01:00'.
+    :param value: (str) timestamp
+    :return: number of seconds since the epoch, or None if the value cannot be parsed
+    """
+    if not value:
+        return None
+
+    # Python 3.6 compatible way to parse the UTC offset with a colon
+    value = re.sub(r"([+-]\d{2}):(\d{2})$", r"\1\2", value)
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z").timestamp()
+    except ValueError:
+        return None